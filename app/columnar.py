@@ -0,0 +1,430 @@
+"""
+Columnar Module
+Local memory-mappable copy of a downloaded csv file
+"""
+import os
+import sys
+import json
+import mmap
+import math
+import shutil
+import struct
+import tempfile
+import itertools
+from array import array
+from contextlib import ExitStack, contextmanager
+from typing import Collection, Iterator, Sequence
+from core import Verbose
+from csvparser import CsvParser
+from decorators import measure
+from metrics import METRICS
+from pricing import is_number
+
+MAGIC = b"GCNCOL01"
+VERSION = 1
+ALIGNMENT = 8
+
+
+def columnar_path(path: str) -> str:
+    """
+    Path of the columnar copy of a csv file
+    records/product_data_0.csv.gz -> records/product_data_0.cols
+    :param path:
+    :return:
+    """
+    for extension in (".gz", ".csv"):
+        if path.endswith(extension):
+            path = path[: -len(extension)]
+    return f"{path}.cols"
+
+
+def source_stamp(path: str) -> dict:
+    """
+    Size and modification time of the source file
+    :param path:
+    :return:
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class ColumnarBase(Verbose):
+    """
+    Columnar Low-Level Interface
+    Layout:
+    magic, metadata length (uint64), metadata JSON, then sections
+    aligned to 8 bytes:
+    float64 column - rows values, NaN for empty values
+    string column - rows + 1 uint64 offsets, UTF-8 data,
+    every value is terminated by NUL to split blocks at once
+    Sections offsets in metadata are relative to the first section
+    """
+
+    numeric = ("price", "old_price")
+    _length = struct.Struct("<Q")
+
+    def __init__(self, path: str, verbose: bool = None) -> None:
+        Verbose.__init__(self, verbose)
+        self._path = path
+
+    @property
+    def path(self) -> str:
+        """
+        Wrapper
+        :return:
+        """
+        return self._path
+
+    @staticmethod
+    def _pad(file, position: int) -> int:
+        """
+        Pad the file to the alignment
+        :param file:
+        :param position:
+        :return: aligned position
+        """
+        padding = -position % ALIGNMENT
+        file.write(b"\0" * padding)
+        return position + padding
+
+    def read_metadata(self) -> dict | None:
+        """
+        Metadata of the file, None if missing or of another version
+        :return:
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                return None
+            (length,) = self._length.unpack(file.read(self._length.size))
+            metadata = json.loads(file.read(length))
+        if (
+            metadata.get("version") != VERSION
+            or metadata.get("byteorder") != sys.byteorder
+        ):
+            return None
+        return metadata
+
+    def is_fresh(self, source: str) -> bool:
+        """
+        Checks if the file was transcoded from the current source
+        :param source:
+        :return:
+        """
+        metadata = self.read_metadata()
+        return (
+            metadata is not None
+            and os.path.exists(source)
+            and metadata["source"] == source_stamp(source)
+        )
+
+
+class Transcoder(ColumnarBase):
+    """
+    Writes the columnar copy of a csv file
+    Columns are streamed to temporary files first,
+    a numeric column is kept as float64
+    only if all its values are plain numbers
+    """
+
+    @measure("columnar.transcode")
+    # pylint: disable-next=too-many-locals
+    def transcode(self, source: str, backend: str = "auto") -> str:
+        """
+        Transcode the source csv file
+        :param source:
+        :param backend: csv parser backend
+        :return: path
+        """
+        self._message(f"Transcoding {source} -> {self.path}")
+        stamp = source_stamp(source)
+        parser = CsvParser(source, backend, self.verbose)
+        folder = os.path.dirname(os.path.abspath(self.path))
+        with ExitStack() as stack:
+            tmp = stack.enter_context(tempfile.TemporaryDirectory(dir=folder))
+            columns = {
+                column: self._column_files(stack, tmp, index)
+                for index, column in enumerate(parser.header)
+            }
+            positions = dict.fromkeys(columns, 0)
+            numeric = {column for column in columns if column in self.numeric}
+            # columns with NUL in values are read value by value
+            unsplittable = set()
+            for offsets, _, _ in columns.values():
+                offsets.write(array("Q", [0]).tobytes())
+            rows = 0
+            for batch in parser.column_batches():
+                for column, values in batch.items():
+                    offsets, data, floats = columns[column]
+                    encoded = [
+                        value.encode("utf-8") + b"\0" for value in values
+                    ]
+                    ends = list(
+                        itertools.accumulate(
+                            map(len, encoded), initial=positions[column]
+                        )
+                    )
+                    positions[column] = ends[-1]
+                    offsets.write(array("Q", ends[1:]).tobytes())
+                    data.write(b"".join(encoded))
+                    if column not in unsplittable and any(
+                        "\0" in value for value in values
+                    ):
+                        unsplittable.add(column)
+                    if column not in numeric:
+                        continue
+                    if all(not value or is_number(value) for value in values):
+                        floats.write(
+                            array(
+                                "d",
+                                [float(value) if value else math.nan
+                                 for value in values],
+                            ).tobytes()
+                        )
+                    else:
+                        numeric.discard(column)
+                rows += len(next(iter(batch.values()), []))
+            self._write(columns, numeric, unsplittable, rows, stamp)
+        METRICS.current().count(
+            rows_in=rows, bytes_written=os.path.getsize(self.path)
+        )
+        return self.path
+
+    @staticmethod
+    def _column_files(stack: ExitStack, folder: str, index: int) -> tuple:
+        return tuple(
+            stack.enter_context(
+                open(os.path.join(folder, f"{index}.{kind}"), "w+b")
+            )
+            for kind in ("offsets", "data", "floats")
+        )
+
+    def _write(  # pylint: disable=too-many-locals,too-many-arguments
+        self,
+        columns: dict,
+        numeric: set,
+        unsplittable: set,
+        rows: int,
+        stamp: dict,
+    ) -> None:
+        """
+        Assemble sections into the file, replaced atomically
+        :param columns:
+        :param numeric:
+        :param unsplittable:
+        :param rows:
+        :param stamp:
+        :return:
+        """
+        layout = []
+        sections = []
+        position = 0
+        for column, (offsets, data, floats) in columns.items():
+            files = (floats,) if column in numeric else (offsets, data)
+            entry = {
+                "name": column,
+                "type": "float64" if column in numeric else "string",
+                "splittable": column not in unsplittable,
+            }
+            for kind, file in zip(
+                ("values",) if column in numeric else ("offsets", "data"),
+                files,
+            ):
+                entry[kind] = position
+                position += file.tell()
+                position += -position % ALIGNMENT
+                sections.append(file)
+            layout.append(entry)
+        metadata = json.dumps(
+            {
+                "version": VERSION,
+                "byteorder": sys.byteorder,
+                "rows": rows,
+                "source": stamp,
+                "columns": layout,
+            }
+        ).encode("utf-8")
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(MAGIC)
+            file.write(self._length.pack(len(metadata)))
+            file.write(metadata)
+            self._pad(file, file.tell())
+            for section in sections:
+                section.seek(0)
+                shutil.copyfileobj(section, file)
+                self._pad(file, file.tell())
+        os.replace(tmp_path, self.path)
+
+
+class ColumnarFile(ColumnarBase):
+    """
+    Scans the columnar copy through mmap
+    Same interface as CsvParser:
+    rows are tuples of the selected columns,
+    rows with a key column value out of the given keys are skipped
+    Values are decoded from the mapped file for selected rows only,
+    empty numeric values are read as empty strings
+    """
+
+    block_rows = 4096
+
+    def __init__(self, path: str, verbose: bool = None) -> None:
+        super().__init__(path, verbose)
+        self._metadata = self.read_metadata()
+        if self._metadata is None:
+            raise ValueError(f"Not a columnar file: {path}")
+        self._rows_read = 0
+
+    @property
+    def header(self) -> list[str]:
+        """
+        Column names
+        :return:
+        """
+        return [column["name"] for column in self._metadata["columns"]]
+
+    @property
+    def index(self) -> dict[str, int]:
+        """
+        Column name: position
+        :return:
+        """
+        return {column: index for index, column in enumerate(self.header)}
+
+    @property
+    def rows_read(self) -> int:
+        """
+        Rows scanned by the last pass, including skipped ones
+        :return:
+        """
+        return self._rows_read
+
+    @contextmanager
+    def _views(self, columns: Collection[str]) -> Iterator[dict]:
+        """
+        Memory views of the columns sections
+        Released before the file is unmapped
+        :param columns:
+        :return: name: (float64 values,)
+        or (uint64 offsets, data, splittable)
+        """
+        rows = self._metadata["rows"]
+        with open(self.path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            buffer = memoryview(mapped)
+            views = {}
+            try:
+                start = len(MAGIC) + self._length.size
+                start += self._length.unpack(buffer[len(MAGIC):start])[0]
+                start += -start % ALIGNMENT
+                for column in self._metadata["columns"]:
+                    if column["name"] not in columns:
+                        continue
+                    if column["type"] == "float64":
+                        values = start + column["values"]
+                        views[column["name"]] = (
+                            buffer[values: values + rows * 8].cast("d"),
+                        )
+                        continue
+                    offsets = start + column["offsets"]
+                    offsets = buffer[offsets: offsets + (rows + 1) * 8]
+                    offsets = offsets.cast("Q")
+                    data = start + column["data"]
+                    views[column["name"]] = (
+                        offsets,
+                        buffer[data: data + offsets[rows]],
+                        column["splittable"],
+                    )
+                yield views
+            finally:
+                for view in itertools.chain.from_iterable(views.values()):
+                    if isinstance(view, memoryview):
+                        view.release()
+                buffer.release()
+                mapped.close()
+
+    @staticmethod
+    def _values(view: tuple, rows: Sequence[int]) -> list:
+        """
+        Decoded values of the rows
+        A block of strings is decoded and split at once
+        :param view:
+        :param rows: range of a block or selected rows
+        :return:
+        """
+        if len(view) == 1:
+            values = view[0]
+            if isinstance(rows, range):
+                values = values[rows.start: rows.stop].tolist()
+            else:
+                values = [values[row] for row in rows]
+            return ["" if math.isnan(value) else value for value in values]
+        offsets, data, splittable = view
+        if isinstance(rows, range) and splittable and len(rows):
+            text = str(
+                data[offsets[rows.start]: offsets[rows.stop] - 1], "utf-8"
+            )
+            return text.split("\0")
+        return [
+            str(data[offsets[row]: offsets[row + 1] - 1], "utf-8")
+            for row in rows
+        ]
+
+    def batches(
+        self,
+        columns: Sequence[str] = None,
+        key: str = None,
+        keys: Collection[str] = None,
+    ) -> Iterator[list[tuple]]:
+        """
+        Rows by blocks
+        :param columns: selected columns in this order, all if not provided
+        :param key: column of the predicate
+        :param keys: values of the key column to keep, all if not provided
+        :return:
+        """
+        columns = self.header if columns is None else list(columns)
+        if keys is None:
+            key = None
+        needed = set(columns) | ({key} if key else set())
+        if missing := needed - set(self.header):
+            raise KeyError(f"{self.path}: unknown columns {sorted(missing)}")
+        self._rows_read = 0
+        total = self._metadata["rows"]
+        with self._views(needed) as views:
+            for start in range(0, total, self.block_rows):
+                rows = range(start, min(total, start + self.block_rows))
+                self._rows_read = rows.stop
+                if key:
+                    rows = [
+                        row
+                        for row, value in zip(
+                            rows, self._values(views[key], rows)
+                        )
+                        if value in keys
+                    ]
+                if rows and columns:
+                    yield list(
+                        zip(
+                            *(
+                                self._values(views[column], rows)
+                                for column in columns
+                            )
+                        )
+                    )
+
+    def rows(
+        self,
+        columns: Sequence[str] = None,
+        key: str = None,
+        keys: Collection[str] = None,
+    ) -> Iterator[tuple]:
+        """
+        Rows of the selected columns
+        See batches
+        :return:
+        """
+        for batch in self.batches(columns, key, keys):
+            yield from batch
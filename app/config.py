@@ -1,14 +1,20 @@
 """
 Configuration Module
+Settings are built lazily on first use
+from command line arguments, environment and defaults
 """
 import os
 import argparse
+from typing import Sequence
 
 
-def arg_parser() -> argparse.Namespace:
+def arg_parser(argv: Sequence[str] = None) -> argparse.Namespace:
     """
     Bash
     Arguments parser
+    Unknown arguments are ignored,
+    so importing modules from other tools never fails
+    :param argv: no arguments (environment and defaults) if not provided
     :return:
     """
     parser = argparse.ArgumentParser(description="GCN Data Pipeline")
@@ -36,19 +42,318 @@ def arg_parser() -> argparse.Namespace:
         required=False,
         action="store_true",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--metrics",
+        help="Write stages metrics report to the file "
+        "(*.prom - Prometheus textfile, JSON otherwise)",
+        required=False,
+        default=os.environ.get("METRICS", ""),
+    )
+    parser.add_argument(
+        "--profile",
+        help="Write cProfile stats of every stage to the folder",
+        required=False,
+        default=os.environ.get("PROFILE", ""),
+    )
+    parser.add_argument(
+        "-bs",
+        "--batch_size",
+        help="Number of records processed at once",
+        required=False,
+        type=int,
+        default=int(os.environ.get("BATCH_SIZE", 10000)),
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of workers of parallel stages",
+        required=False,
+        type=int,
+        default=int(os.environ.get("WORKERS", os.cpu_count() or 1)),
+    )
+    parser.add_argument(
+        "--queue_size",
+        help="Number of batches buffered between pipelines stages",
+        required=False,
+        type=int,
+        default=int(os.environ.get("QUEUE_SIZE", 4)),
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        help="Load data even if input files did not change, "
+        "implied by --refresh",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "-pr",
+        "--pricing_rules",
+        help="JSON/YAML file with discount rules",
+        required=False,
+        default=os.environ.get("PRICING_RULES", ""),
+    )
+    parser.add_argument(
+        "--rejects",
+        help="File of rejected records (gzip JSON lines), "
+        "rejects.jsonl.gz in the records folder by default",
+        required=False,
+        default=os.environ.get("REJECTS", ""),
+    )
+    parser.add_argument(
+        "-e",
+        "--export",
+        help="Export loaded records to the file (path without extension)",
+        required=False,
+        default=os.environ.get("EXPORT", ""),
+    )
+    parser.add_argument(
+        "-ef",
+        "--export_format",
+        help="Export format: parquet, feather (need pyarrow) or csv. "
+        "auto - parquet if pyarrow is installed, csv otherwise",
+        required=False,
+        choices=("auto", "parquet", "feather", "csv"),
+        default=os.environ.get("EXPORT_FORMAT", "auto"),
+    )
+    parser.add_argument(
+        "-dd",
+        "--dedup",
+        help="Duplicate EANs policy",
+        required=False,
+        choices=("none", "first", "last", "max_discount"),
+        default=os.environ.get("DEDUP", "first"),
+    )
+    parser.add_argument(
+        "-dm",
+        "--dedup_memory",
+        help="Records kept in memory by dedup before spilling to disk, "
+        "keys only with first policy",
+        required=False,
+        type=int,
+        default=int(os.environ.get("DEDUP_MEMORY", 1_000_000)),
+    )
+    parser.add_argument(
+        "-dn",
+        "--daemon",
+        help="Run as a daemon with incremental cycles",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "-i",
+        "--interval",
+        help="Daemon: seconds between cycles",
+        required=False,
+        type=float,
+        default=float(os.environ.get("INTERVAL", 60)),
+    )
+    parser.add_argument(
+        "-hf",
+        "--health",
+        help="Daemon: health file, "
+        "health.json in the records folder by default",
+        required=False,
+        default=os.environ.get("HEALTH", ""),
+    )
+    parser.add_argument(
+        "-wt",
+        "--watch",
+        help="Daemon: wake up on records folder changes "
+        "(needs inotify_simple)",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "-fd",
+        "--feeds",
+        help="Feeds registry file (JSON or YAML), "
+        "loads all feeds with a shared workers pool",
+        required=False,
+        default=os.environ.get("FEEDS", ""),
+    )
+    parser.add_argument(
+        "-dc",
+        "--db_connections",
+        help="Feeds: database connections shared by all feeds",
+        required=False,
+        type=int,
+        default=int(os.environ.get("DB_CONNECTIONS", 8)),
+    )
+    parser.add_argument(
+        "-cb",
+        "--csv_backend",
+        help="CSV parser: auto (arrow if pyarrow is installed), "
+        "python or arrow",
+        required=False,
+        choices=("auto", "python", "arrow"),
+        default=os.environ.get("CSV_BACKEND", "auto"),
+    )
+    parser.add_argument(
+        "-tc",
+        "--transcode",
+        help="Transcode the data file into a local columnar copy "
+        "after download, Reader scans the copy while it is fresh",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "-dl",
+        "--delta",
+        help="Load only changes since the previous run: "
+        "none, delete or soft (flag removed records with deleted_at)",
+        required=False,
+        choices=("none", "delete", "soft"),
+        default=os.environ.get("DELTA", "none"),
+    )
+    parser.add_argument(
+        "-cl",
+        "--changelog",
+        help="Delta: changelog file (gzip JSON lines), "
+        "suffixed with the table (changes.jsonl.gz - changes-gcn.jsonl.gz), "
+        "changelog-<table>.jsonl.gz in the records folder by default",
+        required=False,
+        default=os.environ.get("CHANGELOG", ""),
+    )
+    parser.add_argument(
+        "-rf",
+        "--refresh",
+        help="Full refresh: load a shadow table and swap it with the table",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "-rs",
+        "--restore",
+        help="Swap the table (gcn if not given) with its backup "
+        "kept by the last full refresh",
+        required=False,
+        nargs="?",
+        const="gcn",
+        default="",
+        metavar="TABLE",
+    )
+    parser.add_argument(
+        "-pt",
+        "--partitions",
+        help="Create the table hash-partitioned by ean "
+        "into this number of partitions, loaded in parallel",
+        required=False,
+        type=int,
+        default=int(os.environ.get("PARTITIONS", 0)),
+    )
+    return parser.parse_known_args([] if argv is None else argv)[0]
+
+
+class Settings:  # pylint: disable=too-many-instance-attributes
+    """
+    Application settings
+    Priority: command line, environment, defaults
+    Use Settings.get() or get_settings() to access
+    """
+
+    _instance = None
 
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.verbose = args.verbose
+        self.debug = args.debug if args.debug else os.environ.get(
+            "DEBUG", False
+        )
+        self.no_print_out = args.no_print_out
+        self.shrink = args.shrink
+        self.metrics = args.metrics
+        self.profile = args.profile
+        self.batch_size = max(1, args.batch_size)
+        self.workers = max(1, args.workers)
+        self.queue_size = max(1, args.queue_size)
+        self.force = args.force or bool(os.environ.get("FORCE", ""))
+        self.pricing_rules = args.pricing_rules
+        self.export = args.export
+        self.export_format = args.export_format
+        self.dedup = args.dedup
+        self.dedup_memory = max(1, args.dedup_memory)
+        self.daemon = args.daemon or bool(os.environ.get("DAEMON", ""))
+        self.interval = max(0.0, args.interval)
+        self.watch = args.watch
+        self.feeds = args.feeds
+        self.db_connections = max(1, args.db_connections)
+        self.csv_backend = args.csv_backend
+        self.delta = args.delta
+        self.refresh = args.refresh or bool(os.environ.get("REFRESH", ""))
+        self.restore = args.restore
+        self.partitions = max(0, args.partitions)
+        self.changelog = args.changelog
+        self.transcode = args.transcode or bool(
+            os.environ.get("TRANSCODE", "")
+        )
 
-cmd_args = arg_parser()
+        self.folder = os.environ.get("FOLDER", "./records")
+        self.eans = os.environ.get("EANS", "eans.csv")
+        self.data = os.environ.get("DATA", "product_data_0.csv.gz")
+        self.rejects = args.rejects or os.path.join(
+            self.folder, "rejects.jsonl.gz"
+        )
+        self.health = args.health or os.path.join(self.folder, "health.json")
 
-DEBUG = cmd_args.debug if cmd_args.debug else os.environ.get("DEBUG", False)
+        self.db_user = os.environ.get("DB_USER", "test")
+        self.db_password = os.environ.get("DB_PASSWORD", "test")
+        self.db_host = os.environ.get("DB_HOST", "127.0.0.1")
+        self.db_port = os.environ.get("DB_PORT", "5432")
+        self.database = os.environ.get("DATABASE", "test")
 
-FOLDER = "./records"
-EANS = "eans.csv"
-DATA = "product_data_0.csv.gz"
+    @classmethod
+    def get(cls) -> "Settings":
+        """
+        Settings built from environment and defaults on first call,
+        command line is applied by the entry point with configure()
+        :return:
+        """
+        if cls._instance is None:
+            cls._instance = cls(arg_parser())
+        return cls._instance
 
-DB_USER = os.environ.get("DB_USER", "test")
-DB_PASSWORD = os.environ.get("DB_PASSWORD", "test")
-DB_HOST = os.environ.get("DB_HOST", "127.0.0.1")
-DB_PORT = "5432"
-DATABASE = os.environ.get("DATABASE", "test")
+    @classmethod
+    def configure(cls, argv: Sequence[str] = None) -> "Settings":
+        """
+        Rebuild settings from the given arguments
+        For the entry point, tools, tests and workers
+        :param argv:
+        :return:
+        """
+        cls._instance = cls(arg_parser(argv))
+        return cls._instance
+
+
+def get_settings() -> Settings:
+    """
+    Shortcut to Settings.get()
+    :return:
+    """
+    return Settings.get()
+
+
+_LEGACY = {
+    "cmd_args": "args",
+    "DEBUG": "debug",
+    "FOLDER": "folder",
+    "EANS": "eans",
+    "DATA": "data",
+    "DB_USER": "db_user",
+    "DB_PASSWORD": "db_password",
+    "DB_HOST": "db_host",
+    "DB_PORT": "db_port",
+    "DATABASE": "database",
+}
+
+
+def __getattr__(name: str):
+    """
+    Backward compatible module constants
+    resolved from settings on access
+    :param name:
+    :return:
+    """
+    if name in _LEGACY:
+        return getattr(get_settings(), _LEGACY[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
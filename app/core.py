@@ -3,21 +3,109 @@ Module
 with core features used over many other modules
 """
 import os
+import json
+import glob
+import hashlib
+import importlib
 from typing import Callable
-from types import NoneType
-from config import FOLDER, EANS, DATA, cmd_args
+from types import NoneType, ModuleType
+from config import get_settings
+
+
+class LazyImport:
+    """
+    Module proxy
+    Imports the module on first attribute access,
+    so heavy dependencies are loaded only by stages using them
+    """
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module = None
+
+    @property
+    def module(self) -> ModuleType:
+        """
+        Imported module
+        :return:
+        """
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.module, attr)
+
+
+def load_config(path: str) -> dict:
+    """
+    Configuration file: JSON or YAML (if PyYAML is installed)
+    :param path:
+    :return:
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        if os.path.splitext(path)[1].lower() in (".yml", ".yaml"):
+            import yaml  # pylint: disable=import-outside-toplevel
+
+            return yaml.safe_load(file) or {}
+        return json.load(file)
+
+
+def hash_files(paths: list[str], chunk_size: int = 1 << 20) -> str:
+    """
+    Content fingerprint of the files
+    Streamed, files are never loaded whole
+    :param paths:
+    :param chunk_size:
+    :return:
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as file:
+            while chunk := file.read(chunk_size):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+DEV_MODULES = ("tests.py", "check_project.py")
+OUTPUT_SETTINGS = ("dedup", "delta", "partitions", "export", "export_format")
+
+
+def runtime_sources() -> list[str]:
+    """
+    Application modules, tests and tools excluded
+    :return:
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    return sorted(
+        path
+        for path in glob.glob(os.path.join(folder, "*.py"))
+        if os.path.basename(path) not in DEV_MODULES
+    )
+
+
+def code_version() -> str:
+    """
+    Fingerprint of the application sources
+    Changes with any code change affecting the output
+    :return:
+    """
+    return hash_files(runtime_sources())
 
 
 class Verbose:
     """
     Class which prints messages,
     if verbose argument was passed
+    Default comes from settings
     """
-    _verbose = cmd_args.verbose
 
-    def __init__(self, verbose: bool = _verbose) -> None:
+    def __init__(self, verbose: bool = None) -> None:
         self._verbose = (
-            self._verbose if isinstance(verbose, NoneType) else verbose
+            get_settings().verbose
+            if isinstance(verbose, NoneType)
+            else verbose
         )
 
     @property
@@ -37,7 +125,7 @@ class Verbose:
         :param end:
         :return:
         """
-        if cls._verbose:
+        if get_settings().verbose:
             print(msg, end=end)
 
     @classmethod
@@ -50,7 +138,7 @@ class Verbose:
         :param f_kwargs:
         :return:
         """
-        if cls._verbose:
+        if get_settings().verbose:
             func(*f_args, **f_kwargs)
 
     def _message(self, msg: str, end: str = "\n") -> None:
@@ -69,21 +157,20 @@ class FileSystemBase:
     Base Class to Work with file system
     Contains all methods-checks
     To have a stable execution of pipelines
+    Defaults come from settings
     :return:
     """
-    _folder = FOLDER
-    _eans = EANS
-    _data = DATA
 
     def __init__(
         self,
-        folder: str = _folder,
-        eans: str = _eans,
-        data: str = _data,
+        folder: str = None,
+        eans: str = None,
+        data: str = None,
     ) -> None:
-        self._folder = self.normalize(folder)
-        self._eans = self.normalize(eans)
-        self._data = self.normalize(data)
+        settings = get_settings()
+        self._folder = self.normalize(folder or settings.folder)
+        self._eans = self.normalize(eans or settings.eans)
+        self._data = self.normalize(data or settings.data)
         self._files = {
             key: self._make_path(path)
             for key, path in {"eans": self.eans, "data": self.data}.items()
@@ -129,6 +216,25 @@ class FileSystemBase:
         """
         return self._files
 
+    def fingerprint(self) -> str:
+        """
+        Content fingerprint of eans and data files,
+        pricing rules, which change discounts,
+        and settings changing the output
+        :return:
+        """
+        settings = get_settings()
+        paths = list(self.files.values())
+        if rules := settings.pricing_rules:
+            paths.append(rules)
+        options = json.dumps(
+            {name: getattr(settings, name) for name in OUTPUT_SETTINGS},
+            sort_keys=True,
+        )
+        return hashlib.blake2b(
+            f"{hash_files(paths)}{options}".encode(), digest_size=32
+        ).hexdigest()
+
     def _make_path(self, file: str) -> str:
         return os.path.join(self.folder, file)
 
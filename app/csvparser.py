@@ -0,0 +1,314 @@
+"""
+CSV Parser Module
+Positional parsing of csv files into tuples
+with a pluggable native backend
+"""
+import csv
+import gzip
+import importlib.util
+from operator import itemgetter
+from typing import IO, Collection, Iterator, Sequence
+from core import Verbose, LazyImport
+
+pyarrow = LazyImport("pyarrow")
+arrow_csv = LazyImport("pyarrow.csv")
+arrow_compute = LazyImport("pyarrow.compute")
+
+
+def has_arrow_csv() -> bool:
+    """
+    Checks if optional pyarrow is installed
+    :return:
+    """
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+class CsvParserBase(Verbose):
+    """
+    CSV Parser Low-Level Interface
+    Header is mapped to column indexes once,
+    rows are tuples of the selected columns (projection)
+    Rows with a key column value out of the given keys
+    are skipped before the selected columns are built (predicate)
+    Backends:
+    python - csv.reader, arrow - pyarrow.csv (multithreaded C++ parser)
+    auto - arrow if pyarrow is installed
+    Short rows are padded with empty values, arrow switches
+    to python for the rest of the file on a row of another length
+    """
+
+    backends = ("python", "arrow")
+    block_rows = 4096
+    block_size = 1 << 20
+
+    def __init__(
+        self, path: str, backend: str = "auto", verbose: bool = None
+    ) -> None:
+        Verbose.__init__(self, verbose)
+        if backend == "auto":
+            backend = "arrow" if has_arrow_csv() else "python"
+        if backend not in self.backends:
+            raise ValueError(f"Unknown csv backend: {backend}")
+        self._path = path
+        self._backend = backend
+        self._header = None
+        self._rows_read = 0
+
+    @property
+    def path(self) -> str:
+        """
+        Wrapper
+        :return:
+        """
+        return self._path
+
+    @property
+    def rows_read(self) -> int:
+        """
+        Rows scanned by the last pass, including skipped ones
+        :return:
+        """
+        return self._rows_read
+
+    @property
+    def backend(self) -> str:
+        """
+        Wrapper
+        :return:
+        """
+        return self._backend
+
+    @property
+    def header(self) -> list[str]:
+        """
+        Column names, read once from the first row
+        :return:
+        """
+        if self._header is None:
+            with self._open() as file:
+                self._header = next(csv.reader(file), [])
+        return self._header
+
+    @property
+    def index(self) -> dict[str, int]:
+        """
+        Column name: position
+        :return:
+        """
+        return {column: index for index, column in enumerate(self.header)}
+
+    def _open(self) -> IO:
+        if self._path.endswith(".gz"):
+            return gzip.open(self._path, "rt", encoding="utf-8", newline="")
+        return open(self._path, "r", encoding="utf-8", newline="")
+
+    def _columns(self, columns: Sequence[str] = None) -> list[str]:
+        """
+        Selected columns, all columns if not provided
+        :param columns:
+        :return:
+        """
+        if columns is None:
+            return list(self.header)
+        index = self.index
+        if missing := [column for column in columns if column not in index]:
+            raise KeyError(f"{self._path}: unknown columns {missing}")
+        return list(columns)
+
+    def _predicate(self, key: str = None, keys: Collection = None) -> str:
+        """
+        Key column of the predicate, None if rows are not filtered
+        :param key:
+        :param keys:
+        :return:
+        """
+        if key is None or keys is None:
+            return None
+        self._columns([key])
+        return key
+
+
+class CsvParser(CsvParserBase):
+    """
+    CSV Parser High-Level Interface
+    """
+
+    def batches(
+        self,
+        columns: Sequence[str] = None,
+        key: str = None,
+        keys: Collection[str] = None,
+    ) -> Iterator[list[tuple]]:
+        """
+        Rows by blocks of the backend
+        :param columns: selected columns in this order, all if not provided
+        :param key: column of the predicate
+        :param keys: values of the key column to keep, all if not provided
+        :return:
+        """
+        columns = self._columns(columns)
+        key = self._predicate(key, keys)
+        self._rows_read = 0
+        if not columns:
+            return
+        if self.backend == "arrow":
+            for batch in self._arrow_column_batches(columns, key, keys):
+                yield list(zip(*batch.values()))
+            return
+        yield from self._python_batches(columns, key, keys)
+
+    def rows(
+        self,
+        columns: Sequence[str] = None,
+        key: str = None,
+        keys: Collection[str] = None,
+    ) -> Iterator[tuple]:
+        """
+        Rows of the selected columns
+        See batches
+        :return:
+        """
+        for batch in self.batches(columns, key, keys):
+            yield from batch
+
+    def column_batches(
+        self,
+        columns: Sequence[str] = None,
+        key: str = None,
+        keys: Collection[str] = None,
+    ) -> Iterator[dict[str, list]]:
+        """
+        Columns by blocks of the backend
+        See batches
+        :return:
+        """
+        if self.backend == "arrow":
+            columns = self._columns(columns)
+            key = self._predicate(key, keys)
+            self._rows_read = 0
+            if columns:
+                yield from self._arrow_column_batches(columns, key, keys)
+            return
+        columns = self._columns(columns)
+        for batch in self.batches(columns, key, keys):
+            yield dict(zip(columns, map(list, zip(*batch))))
+
+    def _getter(self, columns: list[str]):
+        """
+        Tuple of the selected columns of a parsed row
+        :param columns:
+        :return:
+        """
+        index = self.index
+        if columns == self.header:
+            return tuple
+        if len(columns) == 1:
+            position = index[columns[0]]
+
+            def getter(row: list) -> tuple:
+                return (row[position],)
+
+            return getter
+        return itemgetter(*(index[column] for column in columns))
+
+    def _python_batches(
+        self,
+        columns: list[str],
+        key: str = None,
+        keys: Collection = None,
+        start: int = 0,
+    ) -> Iterator[list[tuple]]:
+        """
+        Row batches parsed by csv.reader
+        Blank lines are skipped
+        :param columns:
+        :param key:
+        :param keys:
+        :param start: number of rows to skip, already read by arrow
+        :return:
+        """
+        getter = self._getter(columns)
+        size = len(self.header)
+        position = self.index[key] if key is not None else None
+        with self._open() as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            batch = []
+            rows = 0
+            for row in reader:
+                if not row:
+                    # blank lines are skipped and not counted, as by arrow
+                    continue
+                rows += 1
+                if rows <= start:
+                    continue
+                if position is not None and (
+                    row[position] if position < len(row) else ""
+                ) not in keys:
+                    continue
+                if len(row) < size:
+                    # short rows are padded with empty values
+                    row += [""] * (size - len(row))
+                batch.append(getter(row))
+                if len(batch) >= self.block_rows:
+                    self._rows_read = rows
+                    yield batch
+                    batch = []
+            self._rows_read = rows
+            if batch:
+                yield batch
+
+    def _arrow_column_batches(
+        self, columns: list[str], key: str = None, keys: Collection = None
+    ) -> Iterator[dict[str, list]]:
+        """
+        Column batches as decoded by pyarrow
+        Predicate is evaluated on the key column by pyarrow,
+        python values are built for matching rows only
+        pyarrow fails on rows of another length than the header,
+        then rows after the last batch are parsed by python
+        :param columns:
+        :param key:
+        :param keys:
+        :return:
+        """
+        try:
+            yield from self._arrow_reader_batches(columns, key, keys)
+        except pyarrow.ArrowInvalid as error:
+            self._message(f"{self._path}: {error}, parsing with python")
+            for batch in self._python_batches(
+                columns, key, keys, start=self._rows_read
+            ):
+                yield dict(zip(columns, map(list, zip(*batch))))
+
+    def _arrow_reader_batches(
+        self, columns: list[str], key: str = None, keys: Collection = None
+    ) -> Iterator[dict[str, list]]:
+        include = columns + [key] if key and key not in columns else columns
+        reader = arrow_csv.open_csv(
+            self._path,
+            read_options=arrow_csv.ReadOptions(block_size=self.block_size),
+            parse_options=arrow_csv.ParseOptions(newlines_in_values=True),
+            convert_options=arrow_csv.ConvertOptions(
+                column_types={column: pyarrow.string() for column in include},
+                include_columns=include,
+                strings_can_be_null=False,
+                quoted_strings_can_be_null=False,
+            ),
+        )
+        if key:
+            value_set = pyarrow.array(list(keys), pyarrow.string())
+        for batch in reader:
+            self._rows_read += batch.num_rows
+            if key:
+                batch = batch.filter(
+                    arrow_compute.is_in(
+                        batch.column(key), value_set=value_set
+                    )
+                )
+                if not batch.num_rows:
+                    continue
+            yield {
+                column: batch.column(column).to_pylist()
+                for column in columns
+            }
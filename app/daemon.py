@@ -0,0 +1,318 @@
+"""
+Daemon Module
+Long-running pipeline with warm state
+"""
+import os
+import json
+import time
+import signal
+import importlib.util
+from functools import partial
+from core import Verbose, FileSystemBase, LazyImport, code_version
+from config import get_settings
+from database import Database
+from reader import Reader
+from engine import Engine, Node
+from metrics import METRICS
+from decorators import measure
+from pipelines import (
+    downloader_pipeline,
+    reader_stage,
+    add_records_nodes,
+)
+
+inotify_simple = LazyImport("inotify_simple")
+
+
+def has_inotify() -> bool:
+    """
+    Checks if optional inotify_simple is installed
+    :return:
+    """
+    return importlib.util.find_spec("inotify_simple") is not None
+
+
+class DaemonBase(Verbose):  # pylint: disable=too-many-instance-attributes
+    """
+    Daemon Low-Level Interface
+    Keeps the database connection, active eans
+    and eans known in the table between cycles
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        table: str = "gcn",
+        interval: float = 60,
+        health: str = "",
+        watch: bool = False,
+        download: bool = True,
+        files: dict = None,
+        database: Database = None,
+        verbose: bool = None,
+    ) -> None:
+        Verbose.__init__(self, verbose)
+        self._message("Initializing Daemon")
+        self._table = table
+        self._interval = interval
+        self._health = health
+        self._download = download
+        self._files_config = files or {}
+        self._files = FileSystemBase(**self._files_config)
+        self._database = database or Database(verbose=verbose)
+        self._known = None
+        self._active = None
+        self._stamps = {}
+        self._stopping = False
+        self._state = {
+            "status": "starting",
+            "pid": os.getpid(),
+            "started_at": time.time(),
+            "cycles": 0,
+            "loaded": 0,
+            "last_cycle_at": None,
+            "last_cycle_time": None,
+            "last_error": None,
+        }
+        self._watcher = self._make_watcher() if watch else None
+
+    @property
+    def state(self) -> dict:
+        """
+        Wrapper
+        :return:
+        """
+        return self._state
+
+    def _make_watcher(self):
+        """
+        inotify watch of the records folder
+        Only events of the input files wake the daemon up,
+        see _wait
+        Falls back to polling if inotify_simple is not installed
+        :return:
+        """
+        if not has_inotify():
+            self._message("inotify_simple is not installed, polling")
+            return None
+        flags = inotify_simple.flags
+        watcher = inotify_simple.INotify()
+        watcher.add_watch(
+            self._files.folder, flags.CLOSE_WRITE | flags.MOVED_TO
+        )
+        return watcher
+
+    def _stamp(self, file: str) -> tuple[int, int] | None:
+        """
+        Size and modification time of an input file
+        :param file:
+        :return:
+        """
+        path = self._files.files[file]
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _changed(self) -> list[str]:
+        """
+        Input files changed since the last cycle
+        :return:
+        """
+        return [
+            file
+            for file in self._files.files
+            if self._stamp(file) != self._stamps.get(file)
+        ]
+
+    def _write_health(self) -> None:
+        """
+        Health file: daemon state and stages metrics
+        Written atomically
+        :return:
+        """
+        if not self._health:
+            return
+        content = json.dumps(
+            self.state | {"updated_at": time.time()}
+            | {"metrics": METRICS.as_dict()},
+            indent=2,
+        )
+        tmp_path = f"{self._health}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(content)
+        os.replace(tmp_path, self._health)
+
+    def _wait(self) -> None:
+        """
+        Sleep until the next cycle
+        Wakes up earlier on inotify events of the input files or shutdown
+        Outputs of the daemon in the same folder (health, rejects,
+        spills) are ignored
+        :return:
+        """
+        inputs = set(map(os.path.basename, self._files.files.values()))
+        deadline = time.monotonic() + self._interval
+        while not self._stopping and (left := deadline - time.monotonic()) > 0:
+            step = min(left, 1.0)
+            if self._watcher is not None:
+                events = self._watcher.read(timeout=int(step * 1000))
+                if any(event.name in inputs for event in events):
+                    return
+            else:
+                time.sleep(step)
+
+    def stop(self, *_args) -> None:
+        """
+        Graceful shutdown: the current cycle is finished first
+        Also a signal handler
+        :return:
+        """
+        self._message("Daemon: stopping")
+        self._stopping = True
+        self._state["status"] = "stopping"
+
+
+class Daemon(DaemonBase):
+    """
+    Daemon High-Level Interface
+    Every cycle polls the sources and loads only
+    records missing in the table
+    """
+
+    def _warm_up(self) -> None:
+        """
+        Load state once per daemon lifetime
+        :return:
+        """
+        if not self._database.table_exists(self._table):
+            self._database.create_table(self._table)
+        self._known = self._database.get_db_eans(self._table)
+        self._message(f"Daemon: known eans - {len(self._known)}")
+        if self._missing_files():
+            return
+        manifest = self._database.get_manifest(self._table)
+        if manifest == (self._files.fingerprint(), code_version()):
+            # inputs are already loaded, wait for the next change
+            self._stamps = self._current_stamps()
+
+    def _missing_files(self) -> bool:
+        """
+        Checks if any input file is missing
+        :return:
+        """
+        return any(self._stamp(file) is None for file in self._files.files)
+
+    def _current_stamps(self) -> dict:
+        return {file: self._stamp(file) for file in self._files.files}
+
+    def _recover(self) -> None:
+        """
+        Make the connection usable after a failed cycle
+        :return:
+        """
+        if self._database.connection.closed:
+            self._database = Database(verbose=self.verbose)
+        else:
+            self._database.rollback()
+
+    def _load(self, csv_records: list) -> None:
+        """
+        Engine node
+        Adds records missing in the known eans
+        :param csv_records:
+        :return:
+        """
+        records_to_add = self._database.compare_records(
+            csv_records, self._table, db_eans=self._known
+        )
+        if records_to_add:
+            self._database.add_records(
+                records_to_add, csv_records, self._table
+            )
+            self._known.update(records_to_add)
+            self._state["loaded"] += len(records_to_add)
+
+    def _build(self) -> Engine:
+        """
+        Incremental pipeline with warm state
+        :return:
+        """
+        settings = get_settings()
+        engine = Engine(queue_size=settings.queue_size, verbose=self.verbose)
+        engine.add(
+            Node(
+                "read",
+                partial(
+                    reader_stage,
+                    None,
+                    verbose=self.verbose,
+                    eans=self._active,
+                    files=self._files_config,
+                ),
+            )
+        )
+        add_records_nodes(
+            engine,
+            "read",
+            self._load,
+            verbose=self.verbose,
+            folder=self._files_config.get("folder"),
+        )
+        return engine
+
+    @measure("daemon.cycle", count_rows=False)
+    def cycle(self) -> bool:
+        """
+        One incremental cycle
+        :return: True if the table was loaded
+        """
+        if self._download:
+            downloader_pipeline(
+                verbose=self.verbose, files=self._files_config
+            )
+        if not (changed := self._changed()):
+            return False
+        if self._missing_files():
+            self._message("Daemon: input files are missing, waiting")
+            return False
+        stamps = self._current_stamps()
+        if "eans" in changed or self._active is None:
+            self._active = Reader(
+                verbose=self.verbose, **self._files_config
+            ).read_eans()
+        self._build().run()
+        self._database.save_manifest(
+            self._table, self._files.fingerprint(), code_version()
+        )
+        self._stamps = stamps
+        return True
+
+    def run(self) -> None:
+        """
+        Run cycles until stopped by SIGTERM/SIGINT
+        :return:
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self._warm_up()
+        self._state["status"] = "running"
+        while not self._stopping:
+            started = time.perf_counter()
+            try:
+                self.cycle()
+                self._state["last_error"] = None
+            except Exception as error:  # pylint: disable=broad-except
+                self._message(f"Daemon: cycle failed: {error!r}")
+                self._state["last_error"] = repr(error)
+                self._recover()
+            self._state["cycles"] += 1
+            self._state["last_cycle_at"] = time.time()
+            self._state["last_cycle_time"] = time.perf_counter() - started
+            self._write_health()
+            METRICS.dump_profiles()
+            settings = get_settings()
+            if settings.metrics:
+                METRICS.report(settings.metrics)
+            self._wait()
+        self._state["status"] = "stopped"
+        self._write_health()
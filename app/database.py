@@ -2,22 +2,23 @@
 Module
 To operate Database
 """
+import io
+import re
 from typing import Any, Collection
-import psycopg2
-from psycopg2 import sql
-from core import Verbose
-from config import DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DATABASE
+from core import Verbose, LazyImport
+from decorators import measure
+from metrics import METRICS
+from config import get_settings
+
+psycopg2 = LazyImport("psycopg2")
+sql = LazyImport("psycopg2.sql")
 
 
 class DatabaseBase(Verbose):
     """
     Database Low-Level Interface
+    Connection defaults come from settings
     """
-    _user = DB_USER
-    _password = DB_PASSWORD
-    _host = DB_HOST
-    _port = DB_PORT
-    _database = DATABASE
     _schema = """
                 id SERIAL PRIMARY KEY,
                 ean VARCHAR(32) UNIQUE NOT NULL,
@@ -32,24 +33,36 @@ class DatabaseBase(Verbose):
                 discount VARCHAR(4)
                 """
     schema = _schema
+    manifest_table = "pipeline_manifest"
+    deleted = "deleted_at"
+    shadow_suffix = "_shadow"
+    partition_key = "ean"
+    backup_suffix = "_backup"
+    manifest_schema = """
+                target VARCHAR(256) PRIMARY KEY,
+                fingerprint VARCHAR(128) NOT NULL,
+                code_version VARCHAR(128) NOT NULL,
+                loaded_at TIMESTAMP NOT NULL DEFAULT NOW()
+                """
 
     def __init__(
             self,
             *args,
-            user: str = _user,
-            password: str = _password,
-            host: str = _host,
-            port: str = _port,
-            database: str = _database,
+            user: str = None,
+            password: str = None,
+            host: str = None,
+            port: str = None,
+            database: str = None,
             **kwargs,
     ) -> None:
         Verbose.__init__(self, *args, **kwargs)
         self._message("Initializing Database")
-        self._user = user
-        self._password = password
-        self._host = host
-        self._port = port
-        self._database = database
+        settings = get_settings()
+        self._user = user or settings.db_user
+        self._password = password or settings.db_password
+        self._host = host or settings.db_host
+        self._port = port or settings.db_port
+        self._database = database or settings.database
         self._connection = self._connect()
         self._cursor = self._get_cursor()
         self._message("Connected to Database")
@@ -139,10 +152,13 @@ class DatabaseBase(Verbose):
         """
         Wrapper
         Generalized
+        Nothing to close if the connection failed
         :return:
         """
-        self.cursor.close()
-        self.connection.close()
+        if getattr(self, "_cursor", None) is not None:
+            self.cursor.close()
+        if getattr(self, "_connection", None) is not None:
+            self.connection.close()
 
 
 class DatabaseStatic:
@@ -185,7 +201,7 @@ class DatabaseStatic:
 
     @staticmethod
     def compare_db_csv(
-            db_eans_records: list[str], csv_eans_records: list[str]
+            db_eans_records: Collection[str], csv_eans_records: list[str]
     ) -> list[str]:
         """
         Returns missed records
@@ -193,6 +209,8 @@ class DatabaseStatic:
         :param csv_eans_records:
         :return:
         """
+        if not isinstance(db_eans_records, (set, frozenset)):
+            db_eans_records = set(db_eans_records)
         return [
             csv_record
             for csv_record in csv_eans_records
@@ -200,18 +218,85 @@ class DatabaseStatic:
         ]
 
     @staticmethod
-    def _columns_from_schema() -> list:
+    def columns_from_schema(schema: str = DatabaseBase.schema) -> list:
         """
         Return schema columns (id excluded)
+        :param schema:
         :return:
         """
         return [
             col
-            for column in DatabaseBase.schema.strip().split(",")
+            for column in schema.strip().split(",")
             if (col := column.strip().split(" ")[0].strip()) != "id"
         ]
 
+    @staticmethod
+    def varchar_lengths(schema: str = DatabaseBase.schema) -> dict[str, int]:
+        """
+        Maximal length of VARCHAR columns
+        :param schema:
+        :return: column: length
+        """
+        return {
+            match[1]: int(match[2])
+            for column in schema.strip().split(",")
+            if (
+                match := re.match(
+                    r"^(\w+)\s+VARCHAR\((\d+)\)", column.strip(), re.I
+                )
+            )
+        }
 
+    @staticmethod
+    def split_schema(
+        schema: str = DatabaseBase.schema,
+    ) -> tuple[str, list[tuple[str, str]]]:
+        """
+        Schema without PRIMARY KEY and UNIQUE column constraints
+        and the removed constraints
+        :param schema:
+        :return: schema, [(constraint, column), ...]
+        """
+        definitions = []
+        constraints = []
+        for definition in schema.strip().split(","):
+            column = definition.strip().split(" ")[0]
+            for constraint in ("PRIMARY KEY", "UNIQUE"):
+                pattern = re.compile(rf"\s{constraint}\b", re.IGNORECASE)
+                if pattern.search(definition):
+                    definition = pattern.sub("", definition)
+                    constraints.append((constraint, column))
+            definitions.append(definition)
+        return ",".join(definitions), constraints
+
+    @staticmethod
+    def copy_line(values: Collection) -> str:
+        """
+        Row of COPY text format
+        :param values:
+        :return:
+        """
+        return "\t".join(
+            "\\N"
+            if value is None
+            else str(value)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+            for value in values
+        ) + "\n"
+
+    @staticmethod
+    def _columns_from_schema() -> list:
+        """
+        Return default schema columns (id excluded)
+        :return:
+        """
+        return DatabaseStatic.columns_from_schema()
+
+
+# pylint: disable-next=too-many-public-methods
 class Database(DatabaseBase, DatabaseStatic):
     """
     Database High-Level Interface
@@ -234,6 +319,7 @@ class Database(DatabaseBase, DatabaseStatic):
         db_eans_records = self.fetch()
         return self._unpack_db_eans_records(db_eans_records)
 
+    @measure("database.add_records")
     def add_records(self,
                     records_to_add: list,
                     csv_records: list,
@@ -250,12 +336,13 @@ class Database(DatabaseBase, DatabaseStatic):
         for record in csv_records:
             record["price"] = self.conv_float(record["price"])
             record["old_price"] = self.conv_float(record["old_price"])
+        columns = self._columns_from_schema()
+        records_to_add = set(records_to_add)
         records_to_add = [
-            tuple(record.values())
+            tuple(record.get(column) for column in columns)
             for record in csv_records
             if record.get("ean", "") in records_to_add
         ]
-        columns = self._columns_from_schema()
         query = sql.SQL(
             """
                 INSERT INTO {} ({})
@@ -265,46 +352,477 @@ class Database(DatabaseBase, DatabaseStatic):
             sql.Identifier(table),
             sql.SQL(",").join(map(sql.Identifier, columns)),
             sql.SQL(",").join(map(sql.Literal, records_to_add)),
-        )
+        ).as_string(self.connection)
         self.execute_query(query)
         self.commit()
+        METRICS.current().count(
+            rows_in=len(csv_records),
+            rows_out=len(records_to_add),
+            bytes_written=len(query),
+        )
         self._message("Successfully added records")
 
-    def compare_records(self, csv_records: list, table: str) -> list[str]:
+    @measure("database.upsert_records")
+    def upsert_records(
+            self, records: list[dict], table: str, restore: bool = False
+    ) -> None:
+        """
+        Insert records or update them by ean
+        :param records: clean records
+        :param table:
+        :param restore: clear soft delete flag
+        :return:
+        """
+        if not records:
+            return
+        self._message(f"Upserting records - {len(records)}")
+        columns = self._columns_from_schema()
+        updates = [
+            sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column))
+            for column in columns
+            if column != "ean"
+        ]
+        if restore:
+            updates.append(
+                sql.SQL("{} = NULL").format(sql.Identifier(self.deleted))
+            )
+        query = sql.SQL(
+            """
+                INSERT INTO {} ({})
+                VALUES {}
+                ON CONFLICT (ean) DO UPDATE SET {}
+                """
+        ).format(
+            sql.Identifier(table),
+            sql.SQL(",").join(map(sql.Identifier, columns)),
+            sql.SQL(",").join(
+                sql.Literal(tuple(record.get(column) for column in columns))
+                for record in records
+            ),
+            sql.SQL(",").join(updates),
+        ).as_string(self.connection)
+        self.execute_query(query)
+        self.commit()
+        METRICS.current().count(
+            rows_in=len(records),
+            rows_out=len(records),
+            bytes_written=len(query),
+        )
+
+    @measure("database.delete_records", count_rows=False)
+    def delete_records(
+            self,
+            eans: list[str],
+            table: str,
+            soft: bool = False,
+            chunk_size: int = 10000,
+    ) -> None:
+        """
+        Delete records by ean in one transaction
+        Soft delete sets the deleted_at flag instead,
+        the column is added if missing
+        :param eans:
+        :param table:
+        :param soft:
+        :param chunk_size:
+        :return:
+        """
+        self._message(
+            f"{'Flagging' if soft else 'Deleting'} records - {len(eans)}"
+        )
+        if soft:
+            self.add_soft_delete(table)
+            query = sql.SQL(
+                """
+                    UPDATE {} SET {} = NOW()
+                    WHERE ean = ANY(%s) AND {} IS NULL
+                    """
+            ).format(
+                sql.Identifier(table),
+                sql.Identifier(self.deleted),
+                sql.Identifier(self.deleted),
+            )
+        else:
+            query = sql.SQL(
+                """
+                    DELETE FROM {} WHERE ean = ANY(%s)
+                    """
+            ).format(sql.Identifier(table))
+        for start in range(0, len(eans), chunk_size):
+            self.execute_query(query, (eans[start: start + chunk_size],))
+        self.commit()
+        METRICS.current().count(rows_out=len(eans))
+
+    def add_soft_delete(self, table: str) -> None:
+        """
+        Soft delete flag column
+        :param table:
+        :return:
+        """
+        query = sql.SQL(
+            """
+                ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} TIMESTAMP
+                """
+        ).format(sql.Identifier(table), sql.Identifier(self.deleted))
+        self.execute_query(query)
+        self.commit()
+
+    @measure("database.copy_records")
+    def copy_records(self, records: list[dict], table: str) -> None:
+        """
+        Bulk load of clean records with COPY
+        :param records:
+        :param table:
+        :return:
+        """
+        if not records:
+            return
+        columns = self._columns_from_schema()
+        buffer = io.StringIO()
+        buffer.writelines(
+            self.copy_line([record.get(column) for column in columns])
+            for record in records
+        )
+        query = sql.SQL("COPY {} ({}) FROM STDIN").format(
+            sql.Identifier(table),
+            sql.SQL(",").join(map(sql.Identifier, columns)),
+        )
+        buffer.seek(0)
+        self.cursor.copy_expert(query.as_string(self.connection), buffer)
+        self.commit()
+        METRICS.current().count(
+            rows_in=len(records),
+            rows_out=len(records),
+            bytes_written=buffer.tell(),
+        )
+
+    def create_shadow_table(
+            self, table: str, schema: str = DatabaseBase.schema
+    ) -> str:
+        """
+        Unlogged table without indexes for a full refresh
+        A shadow left by a failed refresh is dropped
+        :param table:
+        :param schema:
+        :return: shadow table
+        """
+        shadow = f"{table}{self.shadow_suffix}"
+        self._message(f"Creating shadow table: {shadow}")
+        self.drop_table_if_exists(shadow)
+        query = sql.SQL(
+            f"""
+                CREATE UNLOGGED TABLE {"{}"} (
+                {self.split_schema(schema)[0]}
+                );
+                """).format(sql.Identifier(shadow))
+        self.execute_query(query)
+        self.commit()
+        return shadow
+
+    def drop_table_if_exists(self, table: str) -> None:
+        """
+        Drop table without confirmation
+        :param table:
+        :return:
+        """
+        self.execute_query(
+            sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table))
+        )
+        self.commit()
+
+    def _rename_table(self, table: str, name: str) -> None:
+        """
+        Rename table with its indexes and serial sequences
+        Names starting with the table name keep their suffixes
+        Runs in the current transaction
+        :param table:
+        :param name:
+        :return:
+        """
+        self.execute_query(
+            """
+                SELECT c.relname, c.relkind FROM pg_class c
+                JOIN pg_depend d ON d.objid = c.oid
+                WHERE d.refobjid = to_regclass(%s) AND d.deptype = 'a'
+                AND c.relkind = 'S'
+                UNION ALL
+                SELECT indexname, 'i' FROM pg_indexes WHERE tablename = %s
+                """,
+            (table, table),
+        )
+        dependants = self.fetch()
+        self.execute_query(
+            sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                sql.Identifier(table), sql.Identifier(name)
+            )
+        )
+        for relation, kind in dependants:
+            if not relation.startswith(table):
+                continue
+            self.execute_query(
+                sql.SQL(
+                    "ALTER SEQUENCE {} RENAME TO {}"
+                    if kind == "S"
+                    else "ALTER INDEX {} RENAME TO {}"
+                ).format(
+                    sql.Identifier(relation),
+                    sql.Identifier(name + relation[len(table):]),
+                )
+            )
+
+    def _dependent_views(self, table: str) -> list[tuple[str, str, str]]:
+        """
+        Views reading the table with their definitions
+        Definitions refer to the table by name,
+        so they can be recreated on a table renamed in its place
+        :param table:
+        :return: [(schema, view, definition), ...]
+        """
+        self.execute_query(
+            """
+                SELECT DISTINCT n.nspname, v.relname, pg_get_viewdef(v.oid)
+                FROM pg_depend d
+                JOIN pg_rewrite r ON r.oid = d.objid
+                JOIN pg_class v ON v.oid = r.ev_class
+                JOIN pg_namespace n ON n.oid = v.relnamespace
+                WHERE d.refobjid = to_regclass(%s) AND v.relkind = 'v'
+                """,
+            (table,),
+        )
+        return self.fetch()
+
+    def _recreate_views(self, views: list[tuple[str, str, str]]) -> None:
+        """
+        Point views to the table now having their table name
+        Runs in the current transaction
+        :param views: see _dependent_views
+        :return:
+        """
+        for schema, view, definition in views:
+            self.execute_query(
+                sql.SQL("CREATE OR REPLACE VIEW {}.{} AS ").format(
+                    sql.Identifier(schema), sql.Identifier(view)
+                )
+                + sql.SQL(definition.rstrip().rstrip(";"))
+            )
+
+    @measure("database.swap_shadow_table", count_rows=False)
+    def swap_shadow_table(
+            self, table: str, schema: str = DatabaseBase.schema
+    ) -> None:
+        """
+        Finish a full refresh:
+        build constraints and indexes of the shadow table,
+        make it logged, analyze it, then swap it with the table
+        in one short transaction
+        The previous table is kept as backup for restore_backup
+        Views of the table are recreated on the new table,
+        foreign keys and materialized views keep the backup
+        :param table:
+        :param schema:
+        :return:
+        """
+        shadow = f"{table}{self.shadow_suffix}"
+        backup = f"{table}{self.backup_suffix}"
+        self._message(f"Building indexes: {shadow}")
+        for constraint, column in self.split_schema(schema)[1]:
+            suffix = "pkey" if constraint == "PRIMARY KEY" else f"{column}_key"
+            self.execute_query(
+                sql.SQL(
+                    f"ALTER TABLE {{}} ADD CONSTRAINT {{}} {constraint} ({{}})"
+                ).format(
+                    sql.Identifier(shadow),
+                    sql.Identifier(f"{shadow}_{suffix}"),
+                    sql.Identifier(column),
+                )
+            )
+        self.execute_query(
+            sql.SQL("ALTER TABLE {} SET LOGGED").format(sql.Identifier(shadow))
+        )
+        self.commit()
+        self.execute_query(
+            sql.SQL("ANALYZE {}").format(sql.Identifier(shadow))
+        )
+        self.commit()
+        self._message(f"Swapping {shadow} -> {table}")
+        self.execute_query("SET LOCAL lock_timeout = '10s'")
+        self.execute_query(
+            sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(backup))
+        )
+        views = []
+        if self.table_exists(table):
+            views = self._dependent_views(table)
+            self._rename_table(table, backup)
+        self._rename_table(shadow, table)
+        self._recreate_views(views)
+        self.commit()
+        self._message(f"Table refreshed: {table}, previous kept: {backup}")
+
+    def restore_backup(self, table: str) -> None:
+        """
+        Rollback of a full refresh: swap the table with its backup
+        Restoring twice brings the refreshed table back
+        :param table:
+        :return:
+        """
+        backup = f"{table}{self.backup_suffix}"
+        if not self.table_exists(backup):
+            raise LookupError(f"No backup of {table}")
+        swap = f"{table}{self.shadow_suffix}"
+        self.drop_table_if_exists(swap)
+        self.execute_query("SET LOCAL lock_timeout = '10s'")
+        views = self._dependent_views(table)
+        self._rename_table(table, swap)
+        self._rename_table(backup, table)
+        self._rename_table(swap, backup)
+        self._recreate_views(views)
+        self.commit()
+        self._message(f"Table restored from backup: {table}")
+
+    def get_db_eans(self, table: str) -> set[str]:
+        """
+        Returns DB records
+        set of ean
+        :param table:
+        :return:
+        """
+        return set(self._get_db_eans_records(table))
+
+    @measure("database.compare_records")
+    def compare_records(
+            self,
+            csv_records: list,
+            table: str,
+            db_eans: Collection[str] = None,
+    ) -> list[str]:
         """
         Basically for Pipeline
         General method
         To find if there are new records in csv data
         :param csv_records:
         :param table:
+        :param db_eans: known DB eans, fetched from the table if not provided
         :return:
         """
         csv_eans_records = self._get_csv_eans_records(csv_records)
-        db_eans_records = self._get_db_eans_records(table)
+        db_eans_records = (
+            self.get_db_eans(table) if db_eans is None else db_eans
+        )
+        METRICS.current().count(rows_in=len(csv_eans_records))
         return self.compare_db_csv(db_eans_records, csv_eans_records)
 
     def create_table(
-            self, table: str, schema: str = DatabaseBase.schema
+            self,
+            table: str,
+            schema: str = DatabaseBase.schema,
+            partitions: int = 0,
     ) -> None:
         """
         To create table from schema
         See default Schema
+        With partitions the table is hash-partitioned by ean
+        into <table>_p<remainder> partitions,
+        primary key is dropped as it must include ean
         :param table:
         :param schema:
+        :param partitions: number of partitions, 0 - not partitioned
         :return:
         """
         self._message(f"Creating table: {table}")
+        partition_by = ""
+        if partitions:
+            schema = re.sub(r"\sPRIMARY KEY\b", "", schema, flags=re.I)
+            partition_by = f"PARTITION BY HASH ({self.partition_key})"
         query = sql.SQL(
             f"""
                 CREATE TABLE {"{}"} (
                 {schema}
-                );
+                ) {partition_by};
                 """).format(sql.Identifier(table))
         self._message(query.as_string(self.connection))
         self.execute_query(query)
+        for remainder in range(partitions):
+            self.execute_query(
+                sql.SQL(
+                    """
+                    CREATE TABLE {} PARTITION OF {}
+                    FOR VALUES WITH (MODULUS %s, REMAINDER %s)
+                    """
+                ).format(
+                    sql.Identifier(f"{table}_p{remainder}"),
+                    sql.Identifier(table),
+                ),
+                (partitions, remainder),
+            )
         self.commit()
         self._message(f"Table created: {table}")
 
+    def get_partitions(self, table: str) -> list[str]:
+        """
+        Partitions of a hash-partitioned table by remainder
+        Empty if the table is not partitioned
+        :param table:
+        :return:
+        """
+        self.execute_query(
+            """
+                SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = to_regclass(%s)
+                """,
+            (table,),
+        )
+        bounds = {
+            int(re.search(r"remainder (\d+)", bound)[1]): partition
+            for partition, bound in self.fetch()
+        }
+        return [bounds[remainder] for remainder in sorted(bounds)]
+
+    @measure("database.route_partitions", count_rows=False)
+    def route_partitions(
+            self, eans: list[str], table: str, partitions: list[str]
+    ) -> dict[str, list[str]]:
+        """
+        Partition of every ean, computed by the database
+        with the hash partitioning of the table
+        :param eans:
+        :param table:
+        :param partitions: see get_partitions
+        :return: partition: eans
+        """
+        self.execute_query(
+            """
+                SELECT e, r
+                FROM unnest(%s::varchar[]) AS e, unnest(%s::int[]) AS r
+                WHERE satisfies_hash_partition(
+                    to_regclass(quote_ident(%s)), %s, r, e
+                )
+                """,
+            (eans, list(range(len(partitions))), table, len(partitions)),
+        )
+        routes = {}
+        for ean, remainder in self.fetch():
+            routes.setdefault(partitions[remainder], []).append(ean)
+        METRICS.current().count(rows_in=len(eans))
+        return routes
+
+    @measure("database.vacuum_analyze", count_rows=False)
+    def vacuum_analyze(self, table: str) -> None:
+        """
+        VACUUM ANALYZE, which can not run in a transaction
+        :param table:
+        :return:
+        """
+        self._message(f"Vacuum analyze: {table}")
+        self.commit()
+        self.connection.autocommit = True
+        try:
+            self.execute_query(
+                sql.SQL("VACUUM ANALYZE {}").format(sql.Identifier(table))
+            )
+        finally:
+            self.connection.autocommit = False
+
     def drop_table(self, table: str) -> None:
         """
         For Future Use
@@ -326,6 +844,52 @@ class Database(DatabaseBase, DatabaseStatic):
         self.commit()
         self._message(f"Table dropped: {table}")
 
+    def get_manifest(self, table: str) -> tuple[str, str] | None:
+        """
+        Fingerprint and code version
+        of the last successful load of the table
+        None if the table was never loaded
+        :param table:
+        :return:
+        """
+        if not self.table_exists(self.manifest_table):
+            return None
+        query = sql.SQL(
+            """
+                SELECT fingerprint, code_version FROM {} WHERE target = %s
+                """
+        ).format(sql.Identifier(self.manifest_table))
+        self.execute_query(query, (table,))
+        if manifest := self.fetch(1)[0]:
+            return tuple(manifest)
+        return None
+
+    def save_manifest(
+            self, table: str, fingerprint: str, code_version: str
+    ) -> None:
+        """
+        Record a successful load of the table
+        :param table:
+        :param fingerprint:
+        :param code_version:
+        :return:
+        """
+        if not self.table_exists(self.manifest_table):
+            self.create_table(self.manifest_table, self.manifest_schema)
+        self._message(f"Saving manifest: {table}")
+        query = sql.SQL(
+            """
+                INSERT INTO {} (target, fingerprint, code_version)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (target) DO UPDATE
+                SET fingerprint = EXCLUDED.fingerprint,
+                    code_version = EXCLUDED.code_version,
+                    loaded_at = NOW()
+                """
+        ).format(sql.Identifier(self.manifest_table))
+        self.execute_query(query, (table, fingerprint, code_version))
+        self.commit()
+
     def table_exists(self, table: str) -> bool:
         """
         Checks if table exists
@@ -368,3 +932,10 @@ class Database(DatabaseBase, DatabaseStatic):
         :return:
         """
         self.connection.commit()
+
+    def rollback(self) -> None:
+        """
+        Wrapper
+        :return:
+        """
+        self.connection.rollback()
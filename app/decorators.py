@@ -1,8 +1,11 @@
 """
 Decorators Module
 """
+import inspect
 from typing import Callable
+from functools import wraps
 from core import Verbose
+from metrics import METRICS
 
 
 def message(msg: str) -> Callable:
@@ -13,6 +16,7 @@ def message(msg: str) -> Callable:
     """
 
     def decorator(func: Callable) -> Callable:
+        @wraps(func)
         def inner(*args, **kwargs):
             Verbose.message(msg)
             results = func(*args, **kwargs)
@@ -22,3 +26,38 @@ def message(msg: str) -> Callable:
         return inner
 
     return decorator
+
+
+def measure(stage: str, count_rows: bool = True) -> Callable:
+    """
+    Decorator to collect metrics
+    of a function execution as a pipeline stage
+    Rows out are counted from a returned list
+    if count_rows
+    Generator functions are measured until exhausted,
+    rows out are counted from yielded lists
+    """
+
+    def decorator(func: Callable) -> Callable:
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def generator(*args, **kwargs):
+                with METRICS.stage(stage) as metrics:
+                    for results in func(*args, **kwargs):
+                        if count_rows and isinstance(results, list):
+                            metrics.count(rows_out=len(results))
+                        yield results
+
+            return generator
+
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with METRICS.stage(stage) as metrics:
+                results = func(*args, **kwargs)
+                if count_rows and isinstance(results, list):
+                    metrics.count(rows_out=len(results))
+            return results
+
+        return inner
+
+    return decorator
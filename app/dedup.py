@@ -0,0 +1,272 @@
+"""
+Dedup Module
+Duplicate EAN resolution with spill to disk
+"""
+import os
+import re
+import heapq
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import itertools
+from typing import IO, Iterator
+from core import Verbose
+from decorators import measure
+from metrics import METRICS
+
+_number = re.compile(r"-?\d+(\.\d+)?")
+
+
+def discount_value(discount: str) -> float:
+    """
+    Numeric value of a discount like "30%"
+    0 for empty discount
+    :param discount:
+    :return:
+    """
+    match = _number.search(str(discount or ""))
+    return float(match[0]) if match else 0.0
+
+
+# pylint: disable-next=too-many-instance-attributes
+class DeduplicatorBase(Verbose):
+    """
+    Deduplicator Low-Level Interface
+    Every record gets a priority, the lowest one wins:
+    first - input order, last - reversed input order,
+    max_discount - the highest discount, then input order
+    memory_rows counts records kept in memory,
+    only keys with first policy
+    """
+
+    policies = ("first", "last", "max_discount")
+
+    def __init__(
+        self,
+        policy: str = "first",
+        memory_rows: int = 1_000_000,
+        key: str = "ean",
+        folder: str = None,
+        verbose: bool = None,
+    ) -> None:
+        Verbose.__init__(self, verbose)
+        if policy not in self.policies:
+            raise ValueError(f"Unknown dedup policy: {policy}")
+        self._policy = policy
+        self._memory_rows = max(1, memory_rows)
+        self._key = key
+        self._folder = folder
+        self._index = {}
+        self._runs = []
+        self._seq = itertools.count()
+        self._duplicates = 0
+        self._seen = set()
+        self._keys = None
+        self._keys_folder = ""
+
+    @property
+    def policy(self) -> str:
+        """
+        Wrapper
+        :return:
+        """
+        return self._policy
+
+    @property
+    def duplicates(self) -> int:
+        """
+        Number of dropped records
+        Known only after all records were merged,
+        counted while adding with first policy
+        :return:
+        """
+        return self._duplicates
+
+    def _priority(self, record: dict) -> tuple:
+        seq = next(self._seq)
+        match self.policy:
+            case "last":
+                return (-seq,)
+            case "max_discount":
+                return -discount_value(record.get("discount")), seq
+        return (seq,)
+
+    def _spill(self) -> None:
+        """
+        Write in-memory index as a run sorted by key
+        :return:
+        """
+        self._message(f"Dedup: spilling {len(self._index)} records to disk")
+        # pylint: disable-next=consider-using-with
+        run = tempfile.TemporaryFile(dir=self._folder)
+        for key in sorted(self._index):
+            # one pickle per item, memo must not be shared between items
+            pickle.dump(
+                (key, *self._index[key]), run, pickle.HIGHEST_PROTOCOL
+            )
+        METRICS.current().count(bytes_written=run.tell())
+        run.seek(0)
+        self._runs.append(run)
+        self._index = {}
+
+    def _spill_keys(self) -> None:
+        """
+        Move seen keys into an indexed table on disk
+        :return:
+        """
+        self._message(f"Dedup: spilling {len(self._seen)} keys to disk")
+        if self._keys is None:
+            self._keys_folder = tempfile.mkdtemp(dir=self._folder)
+            self._keys = sqlite3.connect(
+                os.path.join(self._keys_folder, "keys.db"),
+                check_same_thread=False,
+            )
+            self._keys.execute(
+                "CREATE TABLE keys (key TEXT PRIMARY KEY) WITHOUT ROWID"
+            )
+        path = os.path.join(self._keys_folder, "keys.db")
+        size = os.path.getsize(path)
+        with self._keys:
+            self._keys.executemany(
+                "INSERT INTO keys VALUES (?)",
+                ((key,) for key in sorted(self._seen)),
+            )
+        METRICS.current().count(bytes_written=os.path.getsize(path) - size)
+        self._seen = set()
+
+    def _spilled(self, keys: list) -> set:
+        """
+        Keys found on disk
+        :param keys:
+        :return:
+        """
+        found = set()
+        if self._keys is None:
+            return found
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(
+                row[0]
+                for row in self._keys.execute(
+                    f"SELECT key FROM keys WHERE key IN ({placeholders})",
+                    chunk,
+                )
+            )
+        return found
+
+    def _drop_keys(self) -> None:
+        self._seen = set()
+        if self._keys is None:
+            return
+        self._keys.close()
+        self._keys = None
+        shutil.rmtree(self._keys_folder, ignore_errors=True)
+
+    @staticmethod
+    def _read_run(run: IO) -> Iterator[tuple]:
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                run.close()
+                return
+
+
+class Deduplicator(DeduplicatorBase):
+    """
+    Deduplicator High-Level Interface
+    first policy streams: a record is emitted when its key is seen
+    for the first time, seen keys are kept in memory
+    and spilled to an indexed table on disk
+    Other policies keep records in an in-memory hash index,
+    which is spilled to sorted runs on disk
+    when it grows over memory_rows
+    Runs are merged when all records were added
+    """
+
+    @measure("dedup.add", count_rows=False)
+    def add(self, batch: list[dict]) -> list[dict] | None:
+        """
+        Add records to the index
+        :param batch:
+        :return: records of new keys with first policy
+        """
+        if self.policy == "first":
+            return self._add_first(batch)
+        index = self._index
+        for record in batch:
+            key = record.get(self._key)
+            priority = self._priority(record)
+            current = index.get(key)
+            if current is None:
+                if len(index) >= self._memory_rows:
+                    self._spill()
+                    index = self._index
+                index[key] = (priority, record)
+            elif priority < current[0]:
+                index[key] = (priority, record)
+        METRICS.current().count(rows_in=len(batch))
+        return None
+
+    def _add_first(self, batch: list[dict]) -> list[dict] | None:
+        """
+        Records of keys not seen before, in input order
+        :param batch:
+        :return:
+        """
+        fresh = {}
+        for record in batch:
+            key = record.get(self._key)
+            if key not in self._seen and key not in fresh:
+                fresh[key] = record
+        for key in self._spilled(list(fresh)):
+            del fresh[key]
+        self._seen.update(fresh)
+        if len(self._seen) >= self._memory_rows:
+            self._spill_keys()
+        self._duplicates += len(batch) - len(fresh)
+        METRICS.current().count(rows_in=len(batch), rows_out=len(fresh))
+        return list(fresh.values()) or None
+
+    def _merged(self) -> Iterator[dict]:
+        """
+        Winner record of every key
+        Input order if nothing was spilled, key order otherwise
+        :return:
+        """
+        if not self._runs:
+            yield from (record for _, record in self._index.values())
+            return
+        self._spill()
+        runs = heapq.merge(
+            *map(self._read_run, self._runs), key=lambda item: item[:2]
+        )
+        self._runs = []
+        for _, group in itertools.groupby(runs, key=lambda item: item[0]):
+            for item in group:
+                yield item[2]
+                break
+
+    @measure("dedup.finish")
+    def finish(self, batch_size: int = 10000) -> Iterator[list]:
+        """
+        Deduplicated records by batches
+        Nothing is left with first policy, records were emitted by add
+        :param batch_size:
+        :return:
+        """
+        if self.policy == "first":
+            self._drop_keys()
+        else:
+            total = next(self._seq)
+            records = self._merged()
+            emitted = 0
+            while batch := list(itertools.islice(records, batch_size)):
+                emitted += len(batch)
+                yield batch
+            self._duplicates = total - emitted
+            self._index = {}
+        if self._duplicates:
+            self._message(f"Dedup: dropped duplicates - {self._duplicates}")
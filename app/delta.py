@@ -0,0 +1,236 @@
+"""
+Delta Module
+Changes between feed snapshots: added, changed and removed records
+"""
+import os
+import gzip
+import json
+import pickle
+import hashlib
+import threading
+from core import Verbose
+from database import Database, DatabaseBase, DatabaseStatic
+from decorators import measure
+from metrics import METRICS
+
+
+def record_hash(record: dict, columns: list[str]) -> bytes:
+    """
+    Digest of the record values
+    :param record:
+    :param columns:
+    :return:
+    """
+    return hashlib.blake2b(
+        "\x1f".join(str(record.get(column)) for column in columns).encode(
+            "utf-8"
+        ),
+        digest_size=16,
+    ).digest()
+
+
+# pylint: disable-next=too-many-instance-attributes
+class DeltaBase(Verbose):
+    """
+    Delta Low-Level Interface
+    Snapshot of the previous run is a dict ean: record hash,
+    kept in the records folder per table
+    Removed records are deleted or flagged (soft)
+    """
+
+    modes = ("delete", "soft")
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        table: str = "gcn",
+        folder: str = "",
+        mode: str = "delete",
+        changelog: str = "",
+        schema: str = DatabaseBase.schema,
+        verbose: bool = None,
+    ) -> None:
+        Verbose.__init__(self, verbose)
+        if mode not in self.modes:
+            raise ValueError(f"Unknown delta mode: {mode}")
+        self._table = table
+        self._mode = mode
+        self._snapshot = os.path.join(folder, f"snapshot-{table}.pickle.gz")
+        self._changelog = changelog
+        self._columns = DatabaseStatic.columns_from_schema(schema)
+        self._previous = None
+        self._current = {}
+        self._counts = {"added": 0, "changed": 0, "removed": 0}
+        self._file = None
+        self._lock = threading.Lock()
+
+    @property
+    def mode(self) -> str:
+        """
+        Wrapper
+        :return:
+        """
+        return self._mode
+
+    @property
+    def counts(self) -> dict:
+        """
+        Number of added, changed and removed records
+        :return:
+        """
+        return self._counts
+
+    @property
+    def snapshot(self) -> str:
+        """
+        Wrapper
+        :return:
+        """
+        return self._snapshot
+
+    @property
+    def changelog(self) -> str:
+        """
+        Wrapper
+        :return:
+        """
+        return self._changelog
+
+    def load_snapshot(self, database: Database = None) -> dict:
+        """
+        Previous snapshot
+        Without a snapshot, eans of the table are taken once
+        with unknown hashes, so their records are rewritten
+        :param database:
+        :return:
+        """
+        if os.path.exists(self.snapshot):
+            with gzip.open(self.snapshot, "rb") as file:
+                return pickle.load(file)
+        self._message(f"Delta: no snapshot of {self._table}, using table")
+        if database is None or not database.table_exists(self._table):
+            return {}
+        return dict.fromkeys(database.get_db_eans(self._table))
+
+    def _save_snapshot(self) -> None:
+        tmp_path = f"{self.snapshot}.tmp"
+        with gzip.open(tmp_path, "wb", compresslevel=1) as file:
+            pickle.dump(self._current, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.snapshot)
+
+    def _open_changelog(self) -> None:
+        if self._file is None:
+            # pylint: disable-next=consider-using-with
+            self._file = gzip.open(
+                f"{self._changelog}.tmp", "wt", encoding="utf-8"
+            )
+
+    def _log(self, lines: list[dict]) -> None:
+        """
+        Append changelog lines, the file is written to .tmp
+        until the delta is committed
+        :param lines:
+        :return:
+        """
+        if not self._changelog or not lines:
+            return
+        self._open_changelog()
+        self._file.writelines(
+            json.dumps(line, ensure_ascii=False, separators=(",", ":"))
+            + "\n"
+            for line in lines
+        )
+
+
+class Delta(DeltaBase):
+    """
+    Delta High-Level Interface
+    add() passes on added and changed records only,
+    commit() applies removals and saves the snapshot
+    and the changelog after a successful load
+    """
+
+    def __init__(self, *args, database: Database = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._message(f"Initializing Delta: {self._mode}")
+        self._database = database
+
+    @property
+    def database(self) -> Database:
+        """
+        Connection, opened only when the table is needed
+        :return:
+        """
+        if self._database is None:
+            self._database = Database(verbose=self.verbose)
+        return self._database
+
+    def _start(self) -> None:
+        self._previous = self.load_snapshot(
+            None if os.path.exists(self.snapshot) else self.database
+        )
+        if os.path.exists(f"{self._changelog}.tmp"):
+            os.remove(f"{self._changelog}.tmp")
+
+    @measure("delta.add")
+    def add(self, batch: list[dict]) -> list[dict]:
+        """
+        Added and changed records of the batch
+        :param batch:
+        :return:
+        """
+        with self._lock:
+            if self._previous is None:
+                self._start()
+            previous = self._previous
+            current = self._current
+            changes = []
+            lines = []
+            for record in batch:
+                ean = record["ean"]
+                digest = record_hash(record, self._columns)
+                if ean in current:
+                    # duplicates without dedup, compare with the first one
+                    known = current[ean]
+                elif ean in previous:
+                    known = previous[ean]
+                else:
+                    known = False
+                current[ean] = digest
+                if known == digest:
+                    continue
+                operation = "added" if known is False else "changed"
+                self._counts[operation] += 1
+                changes.append(record)
+                lines.append({"op": operation, "record": record})
+            self._log(lines)
+        METRICS.current().count(rows_in=len(batch))
+        return changes
+
+    @measure("delta.commit", count_rows=False)
+    def commit(self) -> dict:
+        """
+        Remove records missing in this run,
+        save the snapshot and the changelog
+        :return: counts
+        """
+        if self._previous is None:
+            self._start()
+        removed = [ean for ean in self._previous if ean not in self._current]
+        if removed:
+            self.database.delete_records(
+                removed, self._table, soft=self._mode == "soft"
+            )
+        self._counts["removed"] = len(removed)
+        self._log([{"op": "removed", "ean": ean} for ean in removed])
+        if self._changelog:
+            self._open_changelog()
+            self._file.close()
+            self._file = None
+            os.replace(f"{self._changelog}.tmp", self._changelog)
+        self._save_snapshot()
+        METRICS.current().count(
+            rows_out=sum(self._counts.values()),
+            bytes_written=os.path.getsize(self.snapshot),
+        )
+        self._message(f"Delta: {self._counts}")
+        return self._counts
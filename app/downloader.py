@@ -2,8 +2,11 @@
 Downloader Module
 """
 import os
-import requests
-from core import FileSystemBase, Verbose
+from core import FileSystemBase, Verbose, LazyImport
+from decorators import measure
+from metrics import METRICS
+
+requests = LazyImport("requests")
 
 
 class GoogleDriveDownloader(FileSystemBase, Verbose):
@@ -18,9 +21,17 @@ class GoogleDriveDownloader(FileSystemBase, Verbose):
 
     chunk_size = 655360
 
-    def __init__(self, *args, **kwargs) -> None:
+    def __init__(
+        self,
+        *args,
+        id_eans: str = None,
+        id_data: str = None,
+        **kwargs,
+    ) -> None:
         Verbose.__init__(self, kwargs.pop("verbose", None))
         FileSystemBase.__init__(self, *args, **kwargs)
+        self.id_eans = id_eans or self.id_eans
+        self.id_data = id_data or self.id_data
         self._message("Initializing Downloader")
         self._message("Initializing File System checks")
         self._folder_exists(raise_for_class=False)
@@ -35,7 +46,7 @@ class GoogleDriveDownloader(FileSystemBase, Verbose):
         return self.source.format(file_id=file_id)
 
     @staticmethod
-    def get_file_web_length(response: requests.Response) -> int:
+    def get_file_web_length(response: "requests.Response") -> int:
         """
         Parse file`s size from response header
         :param response:
@@ -56,6 +67,7 @@ class GoogleDriveDownloader(FileSystemBase, Verbose):
                 return True
         return False
 
+    @measure("downloader.download", count_rows=False)
     def download(
         self, link: str, output: str, chunk_size: int = chunk_size
     ) -> str:
@@ -86,6 +98,7 @@ class GoogleDriveDownloader(FileSystemBase, Verbose):
                 progress = 0
                 for chunk in response.iter_content(chunk_size=chunk_size):
                     file.write(chunk)
+                    METRICS.current().count(bytes_written=len(chunk))
                     progress += chunk_size
                     progress = min(file_web_length, progress)
                     self._message(
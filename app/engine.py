@@ -0,0 +1,344 @@
+"""
+Engine Module
+Runs pipelines stages as a graph of nodes
+connected by bounded queues
+"""
+import queue
+import threading
+from collections import deque
+from types import GeneratorType
+from typing import Any, Callable, Iterable, Iterator, Sequence
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from core import Verbose
+
+
+class Cancelled(Exception):
+    """
+    Raised when the engine run was cancelled
+    """
+
+
+class _Done:  # pylint: disable=too-few-public-methods
+    """
+    End of stream marker of an upstream node
+    """
+
+
+DONE = _Done()
+
+
+def _expand(result: Any) -> list:
+    """
+    Items emitted by a node for one call:
+    generator - all yielded items, None - nothing, otherwise the value
+    Module level to be picklable for process workers
+    :param result:
+    :return:
+    """
+    if result is None:
+        return []
+    if isinstance(result, (GeneratorType, Iterator)):
+        return [item for item in result if item is not None]
+    return [result]
+
+
+def _call(func: Callable, item: Any) -> list:
+    """
+    Worker call
+    :param func:
+    :param item:
+    :return:
+    """
+    return _expand(func(item))
+
+
+class Node:  # pylint: disable=too-many-instance-attributes
+    """
+    Pipeline stage declaration
+    Node without inputs is a source: func() is called once
+    Node with inputs: func(item) is called for every upstream item
+    A returned generator emits every yielded item, None emits nothing
+    Generators stream only with one thread worker,
+    otherwise they are collected by the worker first
+    finish() is called once after all input items were handled,
+    its result is emitted the same way
+    """
+
+    modes = ("thread", "process")
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        name: str,
+        func: Callable,
+        inputs: Sequence[str] = (),
+        workers: int = 1,
+        mode: str = "thread",
+        ordered: bool = True,
+        collect: bool = False,
+        finish: Callable = None,
+    ) -> None:
+        if mode not in self.modes:
+            raise ValueError(f"Node {name}: unknown mode {mode}")
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.workers = max(1, workers)
+        self.mode = mode
+        self.ordered = ordered
+        self.collect = collect
+        self.finish = finish
+
+    @property
+    def is_source(self) -> bool:
+        """
+        Wrapper
+        :return:
+        """
+        return not self.inputs
+
+    @property
+    def is_inline(self) -> bool:
+        """
+        Node is run by its driver thread without a pool
+        :return:
+        """
+        return self.workers == 1 and self.mode == "thread"
+
+    def __repr__(self) -> str:
+        return f"Node({self.name!r}, inputs={list(self.inputs)})"
+
+
+class Engine(Verbose):
+    """
+    Runs nodes concurrently
+    Every node has its own bounded input queue (backpressure),
+    items of a node are broadcast to all its downstream nodes
+    The first error cancels the run and is re-raised by Engine.run()
+    """
+
+    poll_interval = 0.1
+
+    def __init__(
+        self, queue_size: int = 4, verbose: bool = None
+    ) -> None:
+        Verbose.__init__(self, verbose)
+        self._queue_size = max(1, queue_size)
+        self._nodes = {}
+        self._queues = {}
+        self._downstream = {}
+        self._results = {}
+        self._errors = []
+        self._cancel = threading.Event()
+
+    @property
+    def nodes(self) -> dict:
+        """
+        Wrapper
+        :return:
+        """
+        return self._nodes
+
+    @property
+    def cancelled(self) -> bool:
+        """
+        Wrapper
+        :return:
+        """
+        return self._cancel.is_set()
+
+    def add(self, node: Node) -> Node:
+        """
+        Register a node
+        Inputs must be registered before
+        :param node:
+        :return:
+        """
+        if node.name in self._nodes:
+            raise ValueError(f"Node already exists: {node.name}")
+        for name in node.inputs:
+            if name not in self._nodes:
+                raise KeyError(f"Node {node.name}: unknown input {name}")
+        self._nodes[node.name] = node
+        self._downstream[node.name] = []
+        for name in node.inputs:
+            self._downstream[name].append(node.name)
+        if not node.is_source:
+            self._queues[node.name] = queue.Queue(self._queue_size)
+        return node
+
+    def cancel(self) -> None:
+        """
+        Stop all nodes as soon as possible
+        :return:
+        """
+        self._cancel.set()
+
+    def _check_cancelled(self) -> None:
+        if self.cancelled:
+            raise Cancelled()
+
+    def _put(self, name: str, item: Any) -> None:
+        """
+        Blocking put, which gives up on cancellation
+        :param name:
+        :param item:
+        :return:
+        """
+        while True:
+            self._check_cancelled()
+            try:
+                self._queues[name].put(item, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                continue
+
+    def _emit(self, node: Node, items: Iterable) -> None:
+        for item in items:
+            if item is None:
+                continue
+            for name in self._downstream[node.name]:
+                self._put(name, item)
+            if node.collect:
+                self._results[node.name].append(item)
+
+    def _input(self, node: Node) -> Iterator:
+        """
+        Items of all upstream nodes in arrival order
+        :param node:
+        :return:
+        """
+        if node.is_source:
+            yield None
+            return
+        pending = len(node.inputs)
+        node_queue = self._queues[node.name]
+        while pending:
+            self._check_cancelled()
+            try:
+                item = node_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            if item is DONE:
+                pending -= 1
+                continue
+            yield item
+
+    def _call_inline(
+        self, node: Node, item: Any, func: Callable = None
+    ) -> None:
+        if func is not None:
+            result = func()
+        elif node.is_source:
+            result = node.func()
+        else:
+            result = node.func(item)
+        if isinstance(result, (GeneratorType, Iterator)):
+            for value in result:
+                self._emit(node, [value])
+            return
+        self._emit(node, _expand(result))
+
+    def _make_pool(self, node: Node):
+        if node.mode == "process":
+            return ProcessPoolExecutor(node.workers)
+        return ThreadPoolExecutor(
+            node.workers, thread_name_prefix=f"engine-{node.name}"
+        )
+
+    def _drain(self, node: Node, pending: deque, limit: int) -> None:
+        """
+        Emit finished results until at most limit calls are in flight
+        Ordered nodes emit in input order
+        :param node:
+        :param pending:
+        :param limit:
+        :return:
+        """
+        while len(pending) > limit:
+            self._check_cancelled()
+            if node.ordered:
+                future = pending[0]
+                done, _ = wait([future], timeout=self.poll_interval)
+                if done:
+                    pending.popleft()
+                    self._emit(node, future.result())
+                continue
+            done, _ = wait(
+                pending, timeout=self.poll_interval,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                pending.remove(future)
+                self._emit(node, future.result())
+
+    def _run_pool(self, node: Node) -> None:
+        pending: deque[Future] = deque()
+        pool = self._make_pool(node)
+        try:
+            for item in self._input(node):
+                pending.append(pool.submit(_call, node.func, item))
+                self._drain(node, pending, node.workers * 2)
+            self._drain(node, pending, 0)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _drive(self, node: Node) -> None:
+        """
+        Node driver thread
+        :param node:
+        :return:
+        """
+        try:
+            if node.is_inline or node.is_source:
+                for item in self._input(node):
+                    self._call_inline(node, item)
+            else:
+                self._run_pool(node)
+            if node.finish is not None:
+                self._check_cancelled()
+                self._call_inline(node, None, node.finish)
+            for name in self._downstream[node.name]:
+                self._put(name, DONE)
+        except Cancelled:
+            pass
+        except Exception as error:  # pylint: disable=broad-except
+            self._message(f"Node {node.name} failed: {error!r}")
+            self._errors.append(error)
+            self.cancel()
+
+    def run(self) -> dict[str, list]:
+        """
+        Run all nodes and wait for them
+        :return: collected items of nodes with collect=True
+        """
+        self._results = {
+            name: [] for name, node in self.nodes.items() if node.collect
+        }
+        threads = [
+            threading.Thread(
+                target=self._drive,
+                args=(node,),
+                name=f"engine-{node.name}",
+                daemon=True,
+            )
+            for node in self.nodes.values()
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(self.poll_interval)
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        if self._errors:
+            raise self._errors[0]
+        self._check_cancelled()
+        return self._results
@@ -0,0 +1,266 @@
+"""
+Exporter Module
+Writes records batches to a compressed columnar file
+"""
+import os
+import csv
+import glob
+import gzip
+import shutil
+import importlib.util
+from core import Verbose, LazyImport
+from database import DatabaseBase, DatabaseStatic
+from decorators import measure
+from metrics import METRICS
+
+pyarrow = LazyImport("pyarrow")
+parquet = LazyImport("pyarrow.parquet")
+
+
+def has_pyarrow() -> bool:
+    """
+    Checks if optional pyarrow is installed
+    :return:
+    """
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+class ExporterBase(Verbose):  # pylint: disable=too-many-instance-attributes
+    """
+    Exporter Low-Level Interface
+    Output is written to temporary files,
+    which replace the previous export only when closed
+    csv parts are kept in <path>.parts.tmp folder until then
+    """
+
+    formats = ("parquet", "feather", "csv")
+    extensions = {
+        "parquet": ".parquet",
+        "feather": ".feather",
+        "csv": ".csv.gz",
+    }
+    numeric = ("price", "old_price")
+
+    def __init__(
+        self,
+        path: str,
+        file_format: str = "auto",
+        schema: str = DatabaseBase.schema,
+        chunk_rows: int = 1_000_000,
+        verbose: bool = None,
+    ) -> None:
+        Verbose.__init__(self, verbose)
+        if file_format == "auto":
+            file_format = "parquet" if has_pyarrow() else "csv"
+        if file_format not in self.formats:
+            raise ValueError(f"Unknown export format: {file_format}")
+        self._path = path
+        self._format = file_format
+        self._columns = DatabaseStatic.columns_from_schema(schema)
+        self._chunk_rows = chunk_rows
+        self._writer = None
+        self._file = None
+        self._tmp = ""
+        self._rows = 0
+        self._parts = []
+        self._pending = []
+
+    @property
+    def format(self) -> str:
+        """
+        Wrapper
+        :return:
+        """
+        return self._format
+
+    @property
+    def columns(self) -> list[str]:
+        """
+        Wrapper
+        :return:
+        """
+        return self._columns
+
+    @property
+    def files(self) -> list[str]:
+        """
+        Files of the export, in place when closed
+        :return:
+        """
+        return self._parts
+
+    def _part_path(self) -> str:
+        """
+        Path of the current output file
+        csv is split into numbered parts of chunk_rows rows
+        :return:
+        """
+        extension = self.extensions[self.format]
+        if self.format == "csv":
+            return f"{self._path}.part-{len(self._parts):05d}{extension}"
+        return f"{self._path}{extension}"
+
+    @property
+    def _parts_folder(self) -> str:
+        return f"{self._path}.parts.tmp"
+
+    def _tmp_path(self) -> str:
+        """
+        Temporary path of the current output file
+        :return:
+        """
+        path = self._part_path()
+        if self.format == "csv":
+            return os.path.join(self._parts_folder, os.path.basename(path))
+        return f"{path}.tmp"
+
+    def _arrow_schema(self):
+        return pyarrow.schema(
+            [
+                (
+                    column,
+                    pyarrow.float64()
+                    if column in self.numeric
+                    else pyarrow.string(),
+                )
+                for column in self.columns
+            ]
+        )
+
+    def _open(self) -> None:
+        self._tmp = self._tmp_path()
+        match self.format:
+            case "parquet":
+                self._writer = parquet.ParquetWriter(
+                    self._tmp, self._arrow_schema(), compression="zstd"
+                )
+            case "feather":
+                self._file = pyarrow.OSFile(self._tmp, "wb")
+                self._writer = pyarrow.ipc.new_file(
+                    self._file,
+                    self._arrow_schema(),
+                    options=pyarrow.ipc.IpcWriteOptions(compression="zstd"),
+                )
+            case "csv":
+                self._file = gzip.open(
+                    self._tmp, "wt", encoding="utf-8", newline=""
+                )
+                self._writer = csv.writer(self._file)
+                self._writer.writerow(self.columns)
+        self._rows = 0
+
+    def _close(self) -> None:
+        if self._writer is None:
+            return
+        if self.format in ("parquet", "feather"):
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+        self._writer = None
+        self._file = None
+        METRICS.current().count(bytes_written=os.path.getsize(self._tmp))
+        self._pending.append(self._tmp)
+        self._parts.append(self._part_path())
+
+    def _discard(self) -> None:
+        """
+        Remove temporary files, the previous export is kept
+        :return:
+        """
+        for tmp_path in self._pending:
+            os.remove(tmp_path)
+        self._pending = []
+        self._parts = []
+        if self.format == "csv":
+            shutil.rmtree(self._parts_folder, ignore_errors=True)
+        elif os.path.exists(tmp_path := self._tmp_path()):
+            os.remove(tmp_path)
+
+    def _publish(self) -> None:
+        """
+        Replace the previous export with the written files
+        Stale csv parts of a longer previous export are removed
+        :return:
+        """
+        for tmp_path, path in zip(self._pending, self._parts):
+            os.replace(tmp_path, path)
+        self._pending = []
+        if self.format != "csv":
+            return
+        for path in glob.glob(f"{glob.escape(self._path)}.part-*.csv.gz"):
+            if path not in self._parts:
+                os.remove(path)
+        os.rmdir(self._parts_folder)
+
+
+class Exporter(ExporterBase):
+    """
+    Exporter High-Level Interface
+    One batch is kept in memory at a time
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._message(f"Initializing Exporter: {self.format}")
+        self._started = False
+
+    def _start(self) -> None:
+        """
+        Prepare the folder of csv parts
+        Parts of an interrupted export are dropped
+        :return:
+        """
+        self._started = True
+        if self.format == "csv":
+            shutil.rmtree(self._parts_folder, ignore_errors=True)
+            os.makedirs(self._parts_folder)
+
+    @measure("exporter.write")
+    def write(self, batch: list[dict]) -> None:
+        """
+        Append records to the export
+        :param batch:
+        :return:
+        """
+        if not self._started:
+            self._start()
+        if self._writer is None:
+            self._open()
+        if self.format == "csv":
+            for record in batch:
+                if self._rows >= self._chunk_rows:
+                    self._close()
+                    self._open()
+                self._writer.writerow(
+                    record.get(column) for column in self.columns
+                )
+                self._rows += 1
+        else:
+            self._writer.write_table(
+                pyarrow.Table.from_pydict(
+                    {
+                        column: [record.get(column) for record in batch]
+                        for column in self.columns
+                    },
+                    schema=self._arrow_schema(),
+                )
+            )
+            self._rows += len(batch)
+        METRICS.current().count(rows_in=len(batch))
+
+    @measure("exporter.close", count_rows=False)
+    def close(self) -> list[str]:
+        """
+        Finish the export
+        Nothing is published if nothing was written,
+        so a skipped run keeps the previous export
+        :return: written files
+        """
+        if not self._started:
+            self._discard()
+            self._message("Nothing to export, previous export is kept")
+            return []
+        self._close()
+        self._publish()
+        self._message(f"Exported: {', '.join(self.files)}")
+        return self.files
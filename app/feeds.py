@@ -0,0 +1,288 @@
+"""
+Feeds Module
+Registry of independent feeds loaded by one scheduler
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from core import Verbose, FileSystemBase, load_config
+from config import get_settings
+from metrics import METRICS
+from pipelines import run_pipeline, release_thread_database
+
+
+class Feed:  # pylint: disable=too-many-instance-attributes
+    """
+    Feed declaration: sources, local files and target table
+    Folder and table default to the feed name,
+    export to the settings export suffixed with the feed name,
+    so concurrent feeds never write the same export
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        name: str,
+        eans_id: str = None,
+        data_id: str = None,
+        folder: str = None,
+        eans: str = None,
+        data: str = None,
+        table: str = None,
+        size: int = None,
+        concurrency: int = 1,
+        export: str = None,
+    ) -> None:
+        if not name:
+            raise ValueError("Feed without a name")
+        settings = get_settings()
+        self.name = name
+        self.eans_id = eans_id
+        self.data_id = data_id
+        self.folder = folder or os.path.join(settings.folder, name)
+        self.eans = eans or settings.eans
+        self.data = data or settings.data
+        self.table = table or name
+        self.size = size
+        self.concurrency = max(1, concurrency)
+        self.export = export
+        if export is None and settings.export:
+            self.export = f"{settings.export}-{name}"
+
+    @property
+    def sources(self) -> dict:
+        """
+        Downloader file ids
+        :return:
+        """
+        return {"id_eans": self.eans_id, "id_data": self.data_id}
+
+    @property
+    def files(self) -> dict:
+        """
+        File system of the feed
+        :return:
+        """
+        return {"folder": self.folder, "eans": self.eans, "data": self.data}
+
+    def estimate_size(self) -> int:
+        """
+        Size used for scheduling:
+        declared size, else size of the last downloaded data file
+        :return:
+        """
+        if self.size is not None:
+            return self.size
+        path = FileSystemBase(**self.files).files["data"]
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def __repr__(self) -> str:
+        return f"Feed({self.name!r}, table={self.table!r})"
+
+
+class FeedRegistry:
+    """
+    Feeds declared in a JSON or YAML (if PyYAML is installed) file
+    {"defaults": {...}, "feeds": [{"name": ..., ...}, ...]}
+    Defaults are applied to every feed
+    """
+
+    def __init__(self, feeds: list[Feed] = None) -> None:
+        self._feeds = {}
+        for feed in feeds or []:
+            self.add(feed)
+
+    @property
+    def feeds(self) -> list[Feed]:
+        """
+        Wrapper
+        :return:
+        """
+        return list(self._feeds.values())
+
+    def add(self, feed: Feed) -> Feed:
+        """
+        Register a feed
+        :param feed:
+        :return:
+        """
+        if feed.name in self._feeds:
+            raise ValueError(f"Feed already exists: {feed.name}")
+        if feed.export and feed.export in (
+            known.export for known in self._feeds.values()
+        ):
+            raise ValueError(f"Export of feed {feed.name} is not unique")
+        self._feeds[feed.name] = feed
+        return feed
+
+    @classmethod
+    def load(cls, path: str) -> "FeedRegistry":
+        """
+        Registry from a file
+        :param path:
+        :return:
+        """
+        config = load_config(path)
+        defaults = config.get("defaults") or {}
+        return cls(
+            [Feed(**(defaults | feed)) for feed in config.get("feeds") or []]
+        )
+
+
+class ConnectionBudget:
+    """
+    Database connections shared by concurrent feeds
+    Connections of a feed are acquired at once to avoid deadlocks
+    """
+
+    def __init__(self, total: int) -> None:
+        self._total = max(1, total)
+        self._available = self._total
+        self._condition = threading.Condition()
+
+    @property
+    def total(self) -> int:
+        """
+        Wrapper
+        :return:
+        """
+        return self._total
+
+    @property
+    def available(self) -> int:
+        """
+        Wrapper
+        :return:
+        """
+        return self._available
+
+    def acquire(self, count: int) -> int:
+        """
+        Wait for free connections
+        :param count: capped by the total
+        :return: acquired connections
+        """
+        count = min(max(1, count), self._total)
+        with self._condition:
+            self._condition.wait_for(lambda: self._available >= count)
+            self._available -= count
+        return count
+
+    def release(self, count: int) -> None:
+        """
+        Return connections
+        :param count:
+        :return:
+        """
+        with self._condition:
+            self._available = min(self._total, self._available + count)
+            self._condition.notify_all()
+
+
+class Scheduler(Verbose):
+    """
+    Loads feeds with a shared pool of workers
+    Largest feeds are started first, so small feeds fill the gaps
+    and the total time is close to the largest feed time
+    Every feed holds its load workers and 2 more connections
+    (manifest check and save) of the shared budget while running,
+    one more with partitions (routing of batches)
+    Partitions are vacuumed after the load by a pool of at most
+    as many connections as load workers, which are closed by then
+    """
+
+    reserved_connections = 2
+
+    def __init__(
+        self,
+        feeds: list[Feed],
+        workers: int = None,
+        db_connections: int = None,
+        verbose: bool = None,
+    ) -> None:
+        Verbose.__init__(self, verbose)
+        settings = get_settings()
+        self._feeds = feeds
+        self._workers = max(1, workers or settings.workers)
+        self._budget = ConnectionBudget(
+            db_connections or settings.db_connections
+        )
+        self._reserved = self.reserved_connections + bool(settings.partitions)
+        self._results = {}
+        self._errors = {}
+
+    @property
+    def results(self) -> dict:
+        """
+        Feed name: False if its load was skipped as a no-op
+        :return:
+        """
+        return self._results
+
+    @property
+    def errors(self) -> dict:
+        """
+        Feed name: error of a failed feed
+        :return:
+        """
+        return self._errors
+
+    def order(self) -> list[Feed]:
+        """
+        Feeds by size, largest first
+        :return:
+        """
+        return sorted(
+            self._feeds, key=lambda feed: feed.estimate_size(), reverse=True
+        )
+
+    def _run_feed(self, feed: Feed) -> bool:
+        """
+        Scheduler worker
+        :param feed:
+        :return:
+        """
+        acquired = self._budget.acquire(
+            feed.concurrency + self._reserved
+        )
+        try:
+            self._message(f"Feed {feed.name}: started")
+            os.makedirs(feed.folder, exist_ok=True)
+            with METRICS.stage(f"feeds.{feed.name}"):
+                return run_pipeline(
+                    feed.table,
+                    self.verbose,
+                    sources=feed.sources,
+                    files=feed.files,
+                    load_workers=max(
+                        1, acquired - self._reserved
+                    ),
+                    export=feed.export,
+                )
+        finally:
+            release_thread_database()
+            self._budget.release(acquired)
+            self._message(f"Feed {feed.name}: finished")
+
+    def run(self) -> dict:
+        """
+        Load all feeds
+        A failed feed does not stop others,
+        the first error is re-raised when all feeds finished
+        :return: results
+        """
+        with ThreadPoolExecutor(
+            self._workers, thread_name_prefix="feeds"
+        ) as pool:
+            futures = {
+                feed.name: pool.submit(self._run_feed, feed)
+                for feed in self.order()
+            }
+        for name, future in futures.items():
+            if (error := future.exception()) is not None:
+                self._message(f"Feed {name} failed: {error!r}")
+                self._errors[name] = error
+            else:
+                self._results[name] = future.result()
+        if self._errors:
+            raise next(iter(self._errors.values()))
+        return self._results
@@ -1,10 +1,10 @@
 """
 GCN Test Task
 """
-
-from pipelines import downloader_pipeline
-from pipelines import reader_pipeline
-from pipelines import database_pipeline
+import sys
+from pipelines import run_pipeline
+from metrics import METRICS
+from config import Settings, get_settings
 
 
 def main() -> None:
@@ -12,13 +12,68 @@ def main() -> None:
     Main Generalized Function
     :return:
     """
-    downloader_pipeline()
-    records = reader_pipeline()
-    database_pipeline(records)
+    settings = get_settings()
+    METRICS.profile_dir = settings.profile or None
+    try:
+        if settings.feeds:
+            feeds()
+        else:
+            run_pipeline()
+    finally:
+        METRICS.dump_profiles()
+        if settings.metrics:
+            METRICS.report(settings.metrics)
+
+
+def feeds() -> None:
+    """
+    Loads all feeds of the registry
+    :return:
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from feeds import FeedRegistry, Scheduler
+
+    Scheduler(FeedRegistry.load(get_settings().feeds).feeds).run()
+
+
+def restore(table: str = "gcn") -> None:
+    """
+    Rollback of the last full refresh
+    :param table: table of the pipeline or of a feed
+    :return:
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from database import Database
+
+    Database().restore_backup(table)
+
+
+def daemon() -> None:
+    """
+    Daemon Entry Point
+    Runs incremental cycles until SIGTERM/SIGINT
+    :return:
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from daemon import Daemon
+
+    settings = get_settings()
+    METRICS.profile_dir = settings.profile or None
+    Daemon(
+        interval=settings.interval,
+        health=settings.health,
+        watch=settings.watch,
+    ).run()
 
 
 if __name__ == "__main__":
     print("Starting application")
     print(__doc__)
-    main()
+    Settings.configure(sys.argv[1:])
+    if get_settings().restore:
+        restore(get_settings().restore)
+    elif get_settings().daemon:
+        daemon()
+    else:
+        main()
     print("Application finished successfully")
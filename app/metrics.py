@@ -0,0 +1,340 @@
+"""
+Metrics Module
+Stage-level timing, counters and profiling of pipelines
+"""
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss() -> int:
+    """
+    Peak resident set size of the process in bytes
+    0 if the platform does not provide it
+    :return:
+    """
+    if resource is None:
+        return 0
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageMetrics:  # pylint: disable=too-many-instance-attributes
+    """
+    Accumulated metrics of a single stage
+    Repeated runs of a stage with the same name are summed up
+    cpu_time is the time of the thread running the stage,
+    peak_rss is the process high-water mark seen at the end of a run,
+    not the memory used by the stage
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss = 0
+        self._lock = threading.Lock()
+
+    def count(
+        self,
+        rows_in: int = 0,
+        rows_out: int = 0,
+        bytes_read: int = 0,
+        bytes_written: int = 0,
+    ) -> None:
+        """
+        Increase counters of the stage
+        :param rows_in:
+        :param rows_out:
+        :param bytes_read:
+        :param bytes_written:
+        :return:
+        """
+        with self._lock:
+            self.rows_in += rows_in
+            self.rows_out += rows_out
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def add_time(self, wall_time: float, cpu_time: float) -> None:
+        """
+        Register one finished run of the stage
+        :param wall_time:
+        :param cpu_time:
+        :return:
+        """
+        with self._lock:
+            self.calls += 1
+            self.wall_time += wall_time
+            self.cpu_time += cpu_time
+            self.peak_rss = max(self.peak_rss, peak_rss())
+
+    @property
+    def rows_per_second(self) -> float:
+        """
+        Throughput by output rows
+        (input rows for stages without output)
+        :return:
+        """
+        rows = self.rows_out or self.rows_in
+        return rows / self.wall_time if self.wall_time else 0.0
+
+    def as_dict(self) -> dict:
+        """
+        Serializable representation
+        :return:
+        """
+        return {
+            "stage": self.name,
+            "calls": self.calls,
+            "wall_time": round(self.wall_time, 6),
+            "cpu_time": round(self.cpu_time, 6),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "rows_per_second": round(self.rows_per_second, 3),
+            "peak_rss": self.peak_rss,
+        }
+
+
+class _NullStage(StageMetrics):
+    """
+    Stage used when counters are reported outside of any stage
+    """
+
+    def __init__(self) -> None:
+        super().__init__("")
+
+    def count(self, *_args, **_kwargs) -> None:
+        return None
+
+
+class Metrics:
+    """
+    Registry of stages metrics
+    Stages are measured with Metrics.stage context manager
+    or with decorators.measure decorator
+    """
+
+    prometheus_prefix = "gcn_stage"
+
+    def __init__(self) -> None:
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = {}
+        self.profile_dir = None
+        self.profiler_hook = None
+
+    @property
+    def stages(self) -> dict:
+        """
+        Wrapper
+        :return:
+        """
+        return self._stages
+
+    def _get_stage(self, name: str) -> StageMetrics:
+        with self._lock:
+            if name not in self._stages:
+                self._stages[name] = StageMetrics(name)
+            return self._stages[name]
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self) -> StageMetrics:
+        """
+        Innermost stage being measured in the current thread
+        Counters reported outside of a stage are dropped
+        :return:
+        """
+        stack = self._stack()
+        return stack[-1] if stack else _NullStage()
+
+    def _profiler(self, name: str):
+        """
+        Per stage profiler:
+        profiler_hook(stage_name) context manager if set,
+        cProfile if profile_dir is set
+        Nested stages are covered by the outer stage profile
+        :param name:
+        :return:
+        """
+        if getattr(self._local, "profiling", False):
+            return nullcontext()
+        if self.profiler_hook is not None:
+            return self._profiling(self.profiler_hook(name))
+        if self.profile_dir:
+            return self._profiling(self._cprofile(name))
+        return nullcontext()
+
+    @contextmanager
+    def _profiling(self, profiler):
+        self._local.profiling = True
+        try:
+            with profiler:
+                yield
+        finally:
+            self._local.profiling = False
+
+    @contextmanager
+    def _cprofile(self, name: str):
+        """
+        cProfile of a stage
+        A profiler per thread, as workers of a stage run at once,
+        stats are written by dump_profiles
+        :param name:
+        :return:
+        """
+        if not hasattr(self._local, "profiles"):
+            self._local.profiles = {}
+        if (profiler := self._local.profiles.get(name)) is None:
+            profiler = self._local.profiles[name] = cProfile.Profile()
+        with self._lock:
+            profilers = self._profiles.setdefault(name, [])
+            if not any(known is profiler for known in profilers):
+                # new thread or metrics were reset
+                profilers.append(profiler)
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+
+    def dump_profiles(self) -> list[str]:
+        """
+        Write stats of every profiled stage
+        to <profile_dir>/<name>.prof, threads of a stage are merged
+        Stats of repeated runs are accumulated
+        Written atomically, call when stages are finished
+        :return: paths
+        """
+        if not self.profile_dir:
+            return []
+        with self._lock:
+            profiles = {
+                name: list(profilers)
+                for name, profilers in self._profiles.items()
+            }
+        os.makedirs(self.profile_dir, exist_ok=True)
+        paths = []
+        for name, profilers in profiles.items():
+            stats = pstats.Stats(profilers[0])
+            for profiler in profilers[1:]:
+                stats.add(profiler)
+            path = os.path.join(self.profile_dir, f"{name}.prof")
+            stats.dump_stats(f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+            paths.append(path)
+        return paths
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measure wall/cpu time of the block
+        cpu time of the current thread only,
+        stages run concurrently in engine threads
+        Yields StageMetrics to report counters
+        :param name:
+        :return:
+        """
+        stage = self._get_stage(name)
+        stack = self._stack()
+        stack.append(stage)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            with self._profiler(name):
+                yield stage
+        finally:
+            stage.add_time(
+                time.perf_counter() - wall_start,
+                time.thread_time() - cpu_start,
+            )
+            stack.pop()
+
+    def reset(self) -> None:
+        """
+        Drop all collected metrics
+        :return:
+        """
+        with self._lock:
+            self._stages = {}
+            self._profiles = {}
+
+    def as_dict(self) -> dict:
+        """
+        Serializable representation
+        :return:
+        """
+        return {
+            "timestamp": time.time(),
+            "peak_rss": peak_rss(),
+            "stages": [stage.as_dict() for stage in self.stages.values()],
+        }
+
+    def as_prometheus(self) -> str:
+        """
+        Prometheus textfile collector format
+        :return:
+        """
+        lines = []
+        fields = (
+            "calls",
+            "wall_time",
+            "cpu_time",
+            "rows_in",
+            "rows_out",
+            "bytes_read",
+            "bytes_written",
+            "rows_per_second",
+            "peak_rss",
+        )
+        stages = [stage.as_dict() for stage in self.stages.values()]
+        for field in fields:
+            metric = f"{self.prometheus_prefix}_{field}"
+            lines.append(f"# TYPE {metric} gauge")
+            for stage in stages:
+                lines.append(
+                    f'{metric}{{stage="{stage["stage"]}"}} {stage[field]}'
+                )
+        return "\n".join(lines) + "\n"
+
+    def report(self, path: str) -> str:
+        """
+        Write report to a file
+        *.prom - Prometheus textfile, JSON otherwise
+        Written atomically, so collectors never read a partial file
+        :param path:
+        :return:
+        """
+        if path.endswith(".prom"):
+            content = self.as_prometheus()
+        else:
+            content = json.dumps(self.as_dict(), indent=2)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+        return path
+
+
+METRICS = Metrics()
@@ -1,59 +1,642 @@
 """
 Pipelines Module
 """
+import os
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
 from downloader import GoogleDriveDownloader
 from reader import Reader
 from database import Database
-from core import Verbose
-from config import cmd_args
-from decorators import message
+from validator import Validator
+from exporter import Exporter
+from dedup import Deduplicator
+from delta import Delta
+from columnar import Transcoder, columnar_path
+from core import Verbose, FileSystemBase, code_version
+from config import get_settings
+from decorators import message, measure
+from engine import Engine, Node
+
+_local = threading.local()
+_table_lock = threading.Lock()
 
 
 @message("Starting Downloader Pipeline")
-def downloader_pipeline(verbose: bool = cmd_args.verbose) -> list:
+@measure("downloader_pipeline", count_rows=False)
+def downloader_pipeline(
+    verbose: bool = None, sources: dict = None, files: dict = None
+) -> list:
     """
     Running Downloader Pipeline
     :param verbose:
+    :param sources: file ids - {"id_eans": ..., "id_data": ...}
+    :param files: file system - {"folder": ..., "eans": ..., "data": ...}
     :return:
     """
-    downloader = GoogleDriveDownloader(verbose=verbose)
+    downloader = GoogleDriveDownloader(
+        verbose=verbose, **(sources or {}), **(files or {})
+    )
     link_eans = downloader.make_link(downloader.id_eans)
     link_data = downloader.make_link(downloader.id_data)
-    return [
+    files = [
         downloader.download(link_eans, downloader.files["eans"]),
         downloader.download(link_data, downloader.files["data"]),
     ]
+    if get_settings().transcode:
+        transcode_data(downloader.files["data"], verbose)
+    return files
 
 
-@message("Starting Reader Pipeline")
-def reader_pipeline(verbose: bool = cmd_args.verbose) -> list:
+def transcode_data(path: str, verbose: bool = None) -> str:
     """
-    Running Reader Pipeline
+    Post-download step
+    Columnar copy of the data file for Reader,
+    kept while the data file does not change
+    :param path:
     :param verbose:
+    :return: columnar copy path
+    """
+    transcoder = Transcoder(columnar_path(path), verbose=verbose)
+    if not transcoder.is_fresh(path):
+        transcoder.transcode(path, get_settings().csv_backend)
+    return transcoder.path
+
+
+def create_table(database: Database, table: str) -> None:
+    """
+    Creates the table if needed, partitioned if configured
+    Partitions get the table name, so they already exist
+    :param database:
+    :param table:
     :return:
     """
-    reader = Reader(verbose=verbose)
-    eans = reader.read_eans()
-    products = reader.read_data(eans)
-    if not cmd_args.no_print_out:
-        Verbose.print(reader.print_out, products)
-    return products
+    with _table_lock:
+        if database.table_exists(table):
+            return
+        database.create_table(table, partitions=get_settings().partitions)
+
+
+class KnownEans:  # pylint: disable=too-few-public-methods
+    """
+    Eans of tables shared by load workers of a run
+    Eans of a table are fetched once, on its first batch,
+    then batches are diffed in memory and their new eans are added
+    """
+
+    def __init__(self) -> None:
+        self._eans = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def claim(
+        self, database: Database, csv_records: list, table: str
+    ) -> list[str]:
+        """
+        New eans of the batch, marked as known
+        so other workers do not add them again
+        :param database:
+        :param csv_records:
+        :param table:
+        :return:
+        """
+        with self._lock:
+            lock = self._locks.setdefault(table, threading.Lock())
+        with lock:
+            if table not in self._eans:
+                self._eans[table] = database.get_db_eans(table)
+            known = self._eans[table]
+            records_to_add = database.compare_records(
+                csv_records, table, db_eans=known
+            )
+            known.update(records_to_add)
+        return records_to_add
 
 
-@message("Starting Database Pipeline")
-def database_pipeline(
-    csv_records: list, table: str = "gcn", verbose: bool = cmd_args.verbose
+def load_records(
+    database: Database,
+    csv_records: list,
+    table: str,
+    known: KnownEans = None,
 ) -> None:
     """
-    Running Database Pipeline
+    Adds missing records to the table
+    Creates the table if needed
+    :param database:
     :param csv_records:
     :param table:
-    :param verbose:
+    :param known: eans of the run, the table is read every call if None
     :return:
     """
-    database = Database(verbose=verbose)
-    if not database.table_exists(table):
-        database.create_table(table)
-    records_to_add = database.compare_records(csv_records, table)
+    create_table(database, table)
+    if known is not None:
+        records_to_add = known.claim(database, csv_records, table)
+    else:
+        records_to_add = database.compare_records(csv_records, table)
     if records_to_add:
         database.add_records(records_to_add, csv_records, table)
+
+
+def upsert_records(
+    database: Database, records: list, table: str, restore: bool = False
+) -> None:
+    """
+    Inserts or updates records by ean
+    Creates the table if needed
+    :param database:
+    :param records:
+    :param table:
+    :param restore: clear soft delete flag
+    :return:
+    """
+    create_table(database, table)
+    database.upsert_records(records, table, restore)
+
+
+def _thread_database(verbose: bool = None) -> Database:
+    """
+    Database connection of the current thread
+    Kept open for all batches handled by the thread
+    :param verbose:
+    :return:
+    """
+    if getattr(_local, "database", None) is None:
+        _local.database = Database(verbose=verbose)
+    return _local.database
+
+
+def release_thread_database() -> None:
+    """
+    Close the database connection of the current thread
+    For long-living threads sharing a connections budget
+    :return:
+    """
+    _local.database = None
+
+
+@measure("reader_stage")
+def reader_stage(
+    _files: list = None,
+    verbose: bool = None,
+    eans: list = None,
+    files: dict = None,
+) -> Iterator[list]:
+    """
+    Engine node
+    Yields batches of filtered records
+    :param _files: downloaded files, used as a start signal
+    :param verbose:
+    :param eans: active eans, read from eans file if not provided
+    :param files: file system - {"folder": ..., "eans": ..., "data": ...}
+    :return:
+    """
+    reader = Reader(verbose=verbose, **(files or {}))
+    if eans is None:
+        eans = reader.read_eans()
+    for batch in reader.read_batches(eans):
+        if not get_settings().no_print_out:
+            Verbose.print(reader.print_out, batch)
+        yield batch
+
+
+@measure("database_stage")
+def database_stage(
+    csv_records: list,
+    table: str = "gcn",
+    verbose: bool = None,
+    known: KnownEans = None,
+) -> None:
+    """
+    Engine node
+    Loads a batch of records with a connection of the worker thread
+    :param csv_records:
+    :param table:
+    :param verbose:
+    :param known: eans of the run, see KnownEans
+    :return:
+    """
+    load_records(_thread_database(verbose), csv_records, table, known)
+
+
+def route_stage(
+    records: list,
+    table: str = "gcn",
+    partitions: list[str] = None,
+    verbose: bool = None,
+) -> Iterator[tuple[str, list]]:
+    """
+    Engine node
+    Splits a batch by partitions of a hash-partitioned table,
+    the database computes the partition of every ean
+    The whole batch goes to the table if it is not partitioned
+    :param records:
+    :param table:
+    :param partitions: partitions of the table, looked up once per run
+    :param verbose:
+    :return: (partition, records)
+    """
+    if not records:
+        return
+    if not partitions:
+        yield table, records
+        return
+    routes = _thread_database(verbose).route_partitions(
+        [record["ean"] for record in records], table, partitions
+    )
+    partition_of = {
+        ean: partition for partition, eans in routes.items() for ean in eans
+    }
+    groups = {}
+    for record in records:
+        groups.setdefault(partition_of[record["ean"]], []).append(record)
+    yield from groups.items()
+
+
+def partition_stage(item: tuple[str, list], load: Callable) -> None:
+    """
+    Engine node
+    Loads records of one partition into the partition,
+    so different partitions are diffed and loaded in parallel
+    :param item: (partition, records)
+    :param load: load stage, called with the partition as table
+    :return:
+    """
+    partition, records = item
+    load(records, table=partition)
+
+
+def vacuum_partitions(
+    partitions: list[str], verbose: bool = None, workers: int = None
+) -> list[str]:
+    """
+    VACUUM ANALYZE of every partition in parallel
+    Runs after the load workers finished, on a pool of at most
+    as many threads, each opens one connection for all its partitions,
+    closed when the pool is shut down
+    :param partitions:
+    :param verbose:
+    :param workers: load workers, settings if not provided
+    :return: vacuumed partitions
+    """
+
+    def vacuum(partition: str) -> None:
+        _thread_database(verbose).vacuum_analyze(partition)
+
+    with ThreadPoolExecutor(
+        max(1, min(workers or get_settings().workers, len(partitions))),
+        thread_name_prefix="vacuum",
+    ) as pool:
+        list(pool.map(vacuum, partitions))
+    return partitions
+
+
+def copy_stage(
+    records: list, table: str = "gcn_shadow", verbose: bool = None
+) -> None:
+    """
+    Engine node
+    Bulk loads a batch into the shadow table of a full refresh
+    :param records:
+    :param table: shadow table
+    :param verbose:
+    :return:
+    """
+    _thread_database(verbose).copy_records(records, table)
+
+
+def upsert_stage(
+    records: list,
+    table: str = "gcn",
+    verbose: bool = None,
+    restore: bool = False,
+) -> None:
+    """
+    Engine node
+    Upserts a batch of changed records with a connection of the worker thread
+    :param records:
+    :param table:
+    :param verbose:
+    :param restore: clear soft delete flag
+    :return:
+    """
+    upsert_records(_thread_database(verbose), records, table, restore)
+
+
+@measure("manifest_stage", count_rows=False)
+def manifest_stage(
+    _files: list = None,
+    table: str = "gcn",
+    verbose: bool = None,
+    files: dict = None,
+) -> str | None:
+    """
+    Engine node
+    Stops the pipeline if inputs, output settings and code did not change
+    since the last successful load of the table
+    A full refresh always runs, as --force
+    :param _files: downloaded files, used as a start signal
+    :param table:
+    :param verbose:
+    :param files: file system - {"folder": ..., "eans": ..., "data": ...}
+    :return: inputs fingerprint to save after the load, None to skip
+    """
+    fingerprint = FileSystemBase(**(files or {})).fingerprint()
+    if get_settings().force or get_settings().refresh:
+        return fingerprint
+    database = _thread_database(verbose)
+    if database.table_exists(table) and database.get_manifest(table) == (
+        fingerprint,
+        code_version(),
+    ):
+        Verbose.message(f"Inputs did not change since last load: {table}")
+        return None
+    return fingerprint
+
+
+def add_records_nodes(  # pylint: disable=too-many-arguments,too-many-locals
+    engine: Engine,
+    source: str,
+    load: Callable,
+    load_workers: int = 1,
+    verbose: bool = None,
+    folder: str = None,
+    export: str = None,
+    delta: Delta = None,
+    route: Callable = None,
+) -> None:
+    """
+    Declares nodes processing batches of records of the source node:
+    source -> validate -> dedup -> delta -> route -> load
+    dedup -> export (optional)
+    dedup is skipped with "none" policy,
+    delta and route only if given
+    :param engine:
+    :param source:
+    :param load: called with every batch of clean records
+    :param load_workers:
+    :param verbose:
+    :param folder: records folder for rejects and spills,
+    settings if not provided
+    :param export: export path, settings if not provided
+    :param delta: load gets added and changed records only
+    :param route: splits batches for the load, see route_stage
+    :return:
+    """
+    settings = get_settings()
+    rejects = settings.rejects
+    if folder:
+        rejects = os.path.join(folder, os.path.basename(settings.rejects))
+    folder = folder or settings.folder
+    export = settings.export if export is None else export
+    validator = Validator(rejects=rejects, verbose=verbose)
+    engine.add(Node("validate", validator.validate, inputs=[source]))
+    records = "validate"
+    if settings.dedup != "none":
+        deduplicator = Deduplicator(
+            settings.dedup,
+            settings.dedup_memory,
+            folder=folder,
+            verbose=verbose,
+        )
+        engine.add(
+            Node(
+                "dedup",
+                deduplicator.add,
+                inputs=["validate"],
+                finish=partial(deduplicator.finish, settings.batch_size),
+            )
+        )
+        records = "dedup"
+    changes = records
+    if delta is not None:
+        engine.add(Node("delta", delta.add, inputs=[records]))
+        changes = "delta"
+    if route is not None:
+        engine.add(Node("route", route, inputs=[changes]))
+        changes = "route"
+    engine.add(
+        Node(
+            "load",
+            load,
+            inputs=[changes],
+            workers=load_workers,
+            ordered=False,
+        )
+    )
+    if export:
+        exporter = Exporter(export, settings.export_format, verbose=verbose)
+        engine.add(
+            Node(
+                "export",
+                exporter.write,
+                inputs=[records],
+                finish=exporter.close,
+            )
+        )
+
+
+def build_pipeline(  # pylint: disable=too-many-arguments
+    table: str = "gcn",
+    verbose: bool = None,
+    sources: dict = None,
+    files: dict = None,
+    load_workers: int = None,
+    export: str = None,
+    delta: Delta = None,
+    shadow: str = None,
+    partitions: list[str] = None,
+) -> Engine:
+    """
+    Declares pipelines stages as engine nodes:
+    download -> manifest -> read -> records nodes
+    See add_records_nodes
+    With a delta, changed records are upserted
+    With a shadow table, all records are copied into it
+    With partitions, batches are routed and loaded by partitions
+    :param table:
+    :param verbose:
+    :param sources: file ids - {"id_eans": ..., "id_data": ...}
+    :param files: file system - {"folder": ..., "eans": ..., "data": ...}
+    :param load_workers: settings if not provided
+    :param export: export path, settings if not provided
+    :param delta:
+    :param shadow: shadow table of a full refresh
+    :param partitions: partitions of the table
+    :return:
+    """
+    settings = get_settings()
+    load = partial(
+        database_stage, table=table, verbose=verbose, known=KnownEans()
+    )
+    if shadow is not None:
+        load = partial(copy_stage, table=shadow, verbose=verbose)
+    elif delta is not None:
+        load = partial(
+            upsert_stage,
+            table=table,
+            verbose=verbose,
+            restore=delta.mode == "soft",
+        )
+    route = None
+    if partitions and shadow is None:
+        route = partial(
+            route_stage, table=table, partitions=partitions, verbose=verbose
+        )
+        load = partial(partition_stage, load=load)
+    engine = Engine(queue_size=settings.queue_size, verbose=verbose)
+    engine.add(
+        Node(
+            "download",
+            partial(
+                downloader_pipeline,
+                verbose=verbose,
+                sources=sources,
+                files=files,
+            ),
+        )
+    )
+    engine.add(
+        Node(
+            "manifest",
+            partial(
+                manifest_stage, table=table, verbose=verbose, files=files
+            ),
+            inputs=["download"],
+            collect=True,
+        )
+    )
+    engine.add(
+        Node(
+            "read",
+            partial(reader_stage, verbose=verbose, files=files),
+            inputs=["manifest"],
+        )
+    )
+    add_records_nodes(
+        engine,
+        "read",
+        load,
+        load_workers=load_workers or settings.workers,
+        verbose=verbose,
+        folder=(files or {}).get("folder"),
+        export=export,
+        delta=delta,
+        route=route,
+    )
+    return engine
+
+
+def table_path(path: str, table: str) -> str:
+    """
+    Path suffixed with the table before its extensions,
+    so tables of concurrent feeds do not share a file
+    :param path:
+    :param table:
+    :return:
+    """
+    folder, name = os.path.split(path)
+    head, dot, extensions = name.partition(".")
+    return os.path.join(folder, f"{head}-{table}{dot}{extensions}")
+
+
+def make_delta(
+    table: str = "gcn",
+    verbose: bool = None,
+    folder: str = None,
+    database: Database = None,
+) -> Delta | None:
+    """
+    Delta of the table from settings
+    None if delta is off
+    :param table:
+    :param verbose:
+    :param folder: records folder, settings if not provided
+    :param database: connection of the run
+    :return:
+    """
+    settings = get_settings()
+    if settings.delta == "none":
+        return None
+    folder = folder or settings.folder
+    changelog = os.path.join(folder, f"changelog-{table}.jsonl.gz")
+    if settings.changelog:
+        changelog = table_path(settings.changelog, table)
+    return Delta(
+        table,
+        folder,
+        settings.delta,
+        changelog,
+        verbose=verbose,
+        database=database,
+    )
+
+
+def prepare_delta(database: Database, table: str, delta: Delta) -> None:
+    """
+    Soft delete flag column for a soft delta,
+    missing in tables loaded before or by a full refresh
+    Added once per run, before records are upserted
+    :param database:
+    :param table:
+    :param delta:
+    :return:
+    """
+    if delta is None or delta.mode != "soft":
+        return
+    create_table(database, table)
+    database.add_soft_delete(table)
+
+
+def run_pipeline(table: str = "gcn", verbose: bool = None, **kwargs) -> bool:
+    """
+    Runs the pipeline
+    Applies the delta and records the manifest after a successful load
+    Full refresh loads a shadow table swapped with the table at the end,
+    partitioned tables can not be refreshed
+    :param table:
+    :param verbose:
+    :param kwargs: see build_pipeline
+    :return: False if the load was skipped as a no-op
+    """
+    database = _thread_database(verbose)
+    delta = shadow = None
+    partitions = []
+    if get_settings().refresh:
+        if database.table_exists(table) and database.get_partitions(table):
+            raise ValueError(
+                f"Full refresh of a partitioned table is not supported: "
+                f"{table}"
+            )
+        shadow = database.create_shadow_table(table)
+    else:
+        delta = make_delta(
+            table,
+            verbose,
+            (kwargs.get("files") or {}).get("folder"),
+            database,
+        )
+        prepare_delta(database, table, delta)
+        if get_settings().partitions:
+            create_table(database, table)
+            partitions = database.get_partitions(table)
+    results = build_pipeline(
+        table,
+        verbose,
+        delta=delta,
+        shadow=shadow,
+        partitions=partitions,
+        **kwargs,
+    ).run()
+    if not results["manifest"]:
+        if shadow is not None:
+            database.drop_table_if_exists(shadow)
+        return False
+    if shadow is not None:
+        database.swap_shadow_table(table)
+    if delta is not None:
+        delta.commit()
+    if partitions:
+        vacuum_partitions(partitions, verbose, kwargs.get("load_workers"))
+    database.save_manifest(table, results["manifest"][0], code_version())
+    return True
@@ -0,0 +1,269 @@
+"""
+Pricing Module
+Discount rules compiled once into batch evaluators
+"""
+import math
+from typing import Callable, Iterable
+from core import load_config
+
+Parser = Callable[[str], float | None]
+Evaluator = Callable[[str, str], str]
+
+ROUNDING = ("half_even", "half_up", "floor", "ceil")
+
+
+def is_number(number: str) -> bool:
+    """
+    Unsigned decimal number with optional fraction
+    :param number:
+    :return:
+    """
+    return number.replace(".", "", 1).isdigit()
+
+
+def make_parser(
+    decimal_separator: str = ".",
+    thousands_separator: str = "",
+    currency: Iterable[str] = (),
+) -> Parser:
+    """
+    Compile a price parser
+    Returns None for values which are not a number
+    :param decimal_separator:
+    :param thousands_separator:
+    :param currency: symbols or codes to strip, e.g. ["€", "EUR"]
+    :return:
+    """
+    currency = tuple(currency)
+    plain = (
+        decimal_separator == "." and not thousands_separator and not currency
+    )
+
+    def parse_plain(value: str) -> float | None:
+        value = str(value)
+        return float(value) if is_number(value) else None
+
+    def parse(value: str) -> float | None:
+        value = str(value)
+        for symbol in currency:
+            value = value.replace(symbol, "")
+        value = value.strip()
+        if thousands_separator:
+            value = value.replace(thousands_separator, "")
+        if decimal_separator != ".":
+            value = value.replace(decimal_separator, ".")
+        return float(value) if is_number(value) else None
+
+    return parse_plain if plain else parse
+
+
+def make_rounder(rounding: str, decimals: int) -> Callable[[float], str]:
+    """
+    Compile discount formatting
+    half_even matches str.format rounding
+    :param rounding:
+    :param decimals:
+    :return:
+    """
+    if rounding not in ROUNDING:
+        raise ValueError(f"Unknown rounding: {rounding}")
+    spec = f".{decimals}f"
+    scale = 10 ** decimals
+    match rounding:
+        case "half_up":
+            return lambda value: format(
+                math.floor(value * scale + 0.5) / scale, spec
+            )
+        case "floor":
+            return lambda value: format(
+                math.floor(value * scale) / scale, spec
+            )
+        case "ceil":
+            return lambda value: format(
+                math.ceil(value * scale) / scale, spec
+            )
+    return lambda value: format(value, spec)
+
+
+def compile_rule(  # pylint: disable=too-many-arguments
+    rounding: str = "half_even",
+    decimals: int = 0,
+    min_discount: float = None,
+    max_discount: float = None,
+    suffix: str = "%",
+    decimal_separator: str = ".",
+    thousands_separator: str = "",
+    currency: Iterable[str] = (),
+    width: int = None,
+) -> Evaluator:
+    """
+    Compile a rule into evaluator(price, old_price) -> discount
+    Empty discount if prices are not numbers,
+    price >= old_price or discount is below min_discount
+    Discount is capped by max_discount
+    Rules producing discounts longer than width are rejected,
+    the widest discount is the cap (100 or max_discount)
+    :param rounding: half_even, half_up, floor, ceil
+    :param decimals:
+    :param min_discount:
+    :param max_discount:
+    :param suffix:
+    :param decimal_separator:
+    :param thousands_separator:
+    :param currency:
+    :param width: maximal length of a discount, not checked if None
+    :return:
+    """
+    parse = make_parser(decimal_separator, thousands_separator, currency)
+    round_ = make_rounder(rounding, decimals)
+    cap = 100 if max_discount is None else min(100, max_discount)
+    if width is not None and len(widest := round_(cap) + suffix) > width:
+        raise ValueError(
+            f"Discount rule output {widest!r} is longer than {width}"
+        )
+
+    def evaluate(price: str, old_price: str) -> str:
+        price = parse(price)
+        old_price = parse(old_price)
+        if price is None or old_price is None or price >= old_price:
+            return ""
+        value = 100 - price * 100 / old_price
+        if min_discount is not None and value < min_discount:
+            return ""
+        if max_discount is not None:
+            value = min(value, max_discount)
+        return round_(value) + suffix
+
+    return evaluate
+
+
+DEFAULT_RULE = compile_rule()  # pylint: disable=invalid-name
+
+
+def match_values(values) -> frozenset[str]:
+    """
+    Values of a rule match field
+    A single value is a list of one value
+    :param values:
+    :return:
+    """
+    if not isinstance(values, (list, tuple, set, frozenset)):
+        values = [values]
+    return frozenset(map(str, values))
+
+
+class Pricing:
+    """
+    Discount rules set
+    Rules are checked in order, the first matching rule is used,
+    records matching no rule use the default rule
+    Rule example:
+    {"match": {"brand": ["Acme"]}, "min_discount": 5, "rounding": "floor"}
+    A single match value is the same as a list of one: {"brand": "Acme"}
+    Rules are checked against the discount column width if given
+    """
+
+    def __init__(
+        self,
+        rules: list[dict] = None,
+        default: dict = None,
+        width: int = None,
+    ) -> None:
+        self._rules = [
+            (
+                {
+                    field: match_values(values)
+                    for field, values in rule.get("match", {}).items()
+                },
+                compile_rule(
+                    **{k: v for k, v in rule.items() if k != "match"},
+                    width=width,
+                ),
+            )
+            for rule in rules or []
+        ]
+        self._default = (
+            compile_rule(**default, width=width) if default else DEFAULT_RULE
+        )
+        self._fields = tuple(
+            sorted({field for match, _ in self._rules for field in match})
+        )
+        self._dispatch = {}
+
+    @property
+    def fields(self) -> tuple[str, ...]:
+        """
+        Record fields read by the rules
+        :return:
+        """
+        return ("price", "old_price") + self._fields
+
+    @classmethod
+    def load(cls, path: str, width: int = None) -> "Pricing":
+        """
+        Rules set from a JSON or YAML (if PyYAML is installed) file
+        {"default": {...}, "rules": [{...}, ...]}
+        :param path:
+        :param width: discount column width
+        :return:
+        """
+        config = load_config(path)
+        return cls(config.get("rules"), config.get("default"), width)
+
+    def _evaluator(self, key: tuple) -> Evaluator:
+        """
+        Rule matching values of match fields
+        Cached, as there are few distinct brands/statuses
+        :param key:
+        :return:
+        """
+        if (evaluate := self._dispatch.get(key)) is None:
+            values = dict(zip(self._fields, key))
+            evaluate = next(
+                (
+                    evaluate
+                    for match, evaluate in self._rules
+                    if all(
+                        values[field] in allowed
+                        for field, allowed in match.items()
+                    )
+                ),
+                self._default,
+            )
+            self._dispatch[key] = evaluate
+        return evaluate
+
+    def discount(self, line: dict) -> str:
+        """
+        Discount of one record
+        :param line:
+        :return:
+        """
+        return self.apply([dict(line)])[0]["discount"]
+
+    def apply(self, batch: list[dict]) -> list[dict]:
+        """
+        Set discount of every record of the batch in place
+        :param batch:
+        :return:
+        """
+        if not self._rules:
+            evaluate = self._default
+            for line in batch:
+                line["discount"] = evaluate(line["price"], line["old_price"])
+            return batch
+        evaluator = self._evaluator
+        if len(self._fields) == 1:
+            field = self._fields[0]
+            for line in batch:
+                line["discount"] = evaluator((str(line.get(field, "")),))(
+                    line["price"], line["old_price"]
+                )
+            return batch
+        fields = self._fields
+        for line in batch:
+            key = tuple(str(line.get(field, "")) for field in fields)
+            line["discount"] = evaluator(key)(
+                line["price"], line["old_price"]
+            )
+        return batch
@@ -1,11 +1,19 @@
 """
 Reader Module
 """
-import csv
-import gzip
-from tabulate import tabulate
-from core import FileSystemBase, Verbose
-from config import cmd_args
+import os
+import itertools
+from typing import Collection, Iterable, Iterator
+from core import FileSystemBase, Verbose, LazyImport
+from config import get_settings
+from csvparser import CsvParser
+from columnar import ColumnarBase, ColumnarFile, columnar_path
+from database import DatabaseBase, DatabaseStatic
+from decorators import measure
+from metrics import METRICS, StageMetrics
+from pricing import DEFAULT_RULE, Pricing
+
+tabulate = LazyImport("tabulate")
 
 
 class ReaderBase(FileSystemBase, Verbose):
@@ -24,23 +32,49 @@ class ReaderBase(FileSystemBase, Verbose):
     def discount(line: dict) -> str:
         """
         Calculating discount
+        with the default pricing rule
         :param line:
         :return:
         """
-        def is_number(number: str) -> bool:
-            return number.replace(".", "", 1).isdigit()
+        return DEFAULT_RULE(line["price"], line["old_price"])
 
-        price = str(line["price"])
-        old_price = str(line["old_price"])
-        if not is_number(price) or not is_number(old_price):
-            return ""
+    @staticmethod
+    def count_rows(lines: Iterable, stage: StageMetrics) -> Iterator:
+        """
+        Pass lines through
+        reporting their number to the stage metrics
+        :param lines:
+        :param stage:
+        :return:
+        """
+        rows = 0
+        for rows, line in enumerate(lines, 1):
+            yield line
+        stage.count(rows_in=rows)
 
-        price = float(price)
-        old_price = float(old_price)
-        if price >= old_price:
-            return ""
+    def parser(self, file: str) -> CsvParser | ColumnarFile:
+        """
+        Parser of an input file
+        Columnar copy if transcoding is on and the copy is fresh,
+        otherwise csv parser with the backend from settings
+        :param file:
+        :return:
+        """
+        path = self.files[file]
+        settings = get_settings()
+        if settings.transcode and ColumnarBase(
+            columnar_path(path)
+        ).is_fresh(path):
+            return ColumnarFile(columnar_path(path), self.verbose)
+        return CsvParser(path, settings.csv_backend, self.verbose)
 
-        return f"{100 - price * 100 / old_price:.0f}%"
+    def _count_bytes_read(self, file: str) -> None:
+        """
+        Report size of a file on disk to the current stage metrics
+        :param file:
+        :return:
+        """
+        METRICS.current().count(bytes_read=os.path.getsize(self.files[file]))
 
     @staticmethod
     def shrink_line(line: dict, length: int = 10) -> dict:
@@ -52,7 +86,9 @@ class ReaderBase(FileSystemBase, Verbose):
         :return:
         """
         return {
-            key: value[:length] + "..." if len(value) > length else value
+            key: value[:length] + "..."
+            if isinstance(value, str) and len(value) > length
+            else value
             for key, value in line.items()
         }
 
@@ -71,55 +107,127 @@ class Reader(ReaderBase):
     """
     Reader High-Level Interface
     """
-    def __init__(self, *args, **kwargs) -> None:
+    def __init__(self, *args, pricing: Pricing = None, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self._message("Initializing Reader")
+        self._pricing = pricing or self.load_pricing()
+
+    @staticmethod
+    def load_pricing() -> Pricing:
+        """
+        Pricing rules from settings
+        checked against the discount column
+        Default rule if not configured
+        :return:
+        """
+        if path := get_settings().pricing_rules:
+            return Pricing.load(
+                path, DatabaseStatic.varchar_lengths().get("discount")
+            )
+        return Pricing()
+
+    @property
+    def pricing(self) -> Pricing:
+        """
+        Wrapper
+        :return:
+        """
+        return self._pricing
+
+    def projection(
+        self, header: list[str], schema: str = DatabaseBase.schema
+    ) -> list[str]:
+        """
+        Columns of the data file needed by the sinks:
+        schema columns and fields of pricing rules, in file order
+        :param header:
+        :param schema:
+        :return:
+        """
+        needed = set(DatabaseStatic.columns_from_schema(schema))
+        needed.update(self.pricing.fields)
+        return [column for column in header if column in needed]
 
+    @measure("reader.read_eans")
     def read_eans(self) -> list:
         """
         Parse active Eans
         :return:
         """
         self._message("Reading Eans")
-        with open(self.files["eans"], "r", encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            return [line["ean"] for line in reader if line["active"] == "1"]
+        self._count_bytes_read("eans")
+        reader = self.count_rows(
+            self.parser("eans").rows(["ean", "active"]), METRICS.current()
+        )
+        return [ean for ean, active in reader if active == "1"]
+
+    def read_data(self, eans: Collection[str] = None) -> list:
+        """
+        Parse and filter data from csv
+        :param eans:
+        :return:
+        """
+        return [
+            line
+            for batch in self.read_batches(eans, batch_size=0)
+            for line in batch
+        ]
 
-    def read_data(self, eans: list = None) -> list:
+    @measure("reader.read_data")
+    def read_batches(
+        self,
+        eans: Collection[str] = None,
+        batch_size: int = None,
+        columns: list[str] = None,
+    ) -> Iterator[list]:
         """
         Parse and filter data from csv
+        by batches of filtered records
+        Rows of other eans are skipped before their columns are built
         :param eans:
+        :param batch_size: from settings if not provided, 0 - one batch
+        :param columns: projection from the schema if not provided
         :return:
         """
+        if batch_size is None:
+            batch_size = get_settings().batch_size
         self._message(
             f"Reading Data. "
             f"Filter: {'eans - active only' if eans else 'all records'}"
         )
-        with gzip.open(self.files["data"], "rt") as csvfile:
-            reader = csv.DictReader(csvfile)
-            if eans:
-                return [
-                    line | {"discount": self.discount(line)}
-                    for line in reader
-                    if line["ean"] in eans
-                ]
-            return [
-                line | {"discount": self.discount(line)} for line in reader
-            ]
+        stage = METRICS.current()
+        parser = self.parser("data")
+        stage.count(bytes_read=os.path.getsize(parser.path))
+        if columns is None:
+            columns = self.projection(parser.header)
+        keys = set(eans) if eans else None
+        # dicts are built only for rows passing the filter
+        lines = (
+            dict(zip(columns, row))
+            for row in parser.rows(columns, "ean", keys)
+        )
+        if not batch_size:
+            yield self.pricing.apply(list(lines))
+        else:
+            while batch := list(itertools.islice(lines, batch_size)):
+                yield self.pricing.apply(batch)
+        stage.count(rows_in=parser.rows_read)
 
     @staticmethod
     def print_out(
-        data: list[dict[str:str]], shrink: bool = cmd_args.shrink
+        data: list[dict[str:str]], shrink: bool = None
     ) -> None:
         """
         Print out parsed and filtered data from csv file
         :param data:
-        :param shrink:
+        :param shrink: from settings if not provided
         :return:
         """
+        if shrink is None:
+            shrink = get_settings().shrink
         data = Reader.shrink_list(data) if shrink else data
         print(
-            tabulate(
+            tabulate.tabulate(
                 data,
                 headers="keys",
                 showindex=True,
@@ -1,8 +1,128 @@
 """
 Unittest Module
 """
+# pylint: disable=too-many-lines
+import os
+import csv
+import gzip
+import json
+import pickle
+import pstats
+import tempfile
+import threading
 import unittest
+import sys
+from unittest import mock
+import time
+from types import SimpleNamespace
+from functools import partial
+from config import Settings
+import pipelines
+from core import LazyImport, runtime_sources
 from reader import Reader
+from metrics import Metrics
+from engine import Engine, Node
+from pricing import Pricing
+from validator import Validator, gtin_is_valid
+from exporter import Exporter
+from dedup import Deduplicator
+from csvparser import CsvParser, has_arrow_csv
+from columnar import ColumnarFile, Transcoder
+from database import Database, DatabaseBase, DatabaseStatic
+from delta import Delta, record_hash
+from daemon import Daemon
+from feeds import ConnectionBudget, Feed, FeedRegistry, Scheduler
+from pipelines import (
+    KnownEans,
+    load_records,
+    partition_stage,
+    prepare_delta,
+    upsert_records,
+)
+
+
+class StubDatabase(DatabaseStatic):
+    """
+    In-memory Database for pipelines tests
+    Tables are dicts ean: record, queries are counted
+    """
+
+    # pylint: disable=missing-function-docstring
+    deleted = DatabaseBase.deleted
+
+    def __init__(self, tables: dict = None) -> None:
+        self.tables = tables or {}
+        self.columns = {table: set() for table in self.tables}
+        self.manifests = {}
+        self.queries = []
+
+    def table_exists(self, table: str) -> bool:
+        return table in self.tables
+
+    def create_table(self, table: str, *_args, **_kwargs) -> None:
+        self.tables[table] = {}
+        self.columns[table] = set()
+
+    def add_soft_delete(self, table: str) -> None:
+        self.columns[table].add(self.deleted)
+
+    def get_db_eans(self, table: str) -> set[str]:
+        self.queries.append(("eans", table))
+        return set(self.tables[table])
+
+    def compare_records(
+        self, csv_records: list, table: str, db_eans: set = None
+    ) -> list[str]:
+        if db_eans is None:
+            db_eans = self.get_db_eans(table)
+        return self.compare_db_csv(
+            db_eans, [record["ean"] for record in csv_records]
+        )
+
+    def add_records(
+        self, records_to_add: list, csv_records: list, table: str
+    ) -> None:
+        for record in csv_records:
+            if record["ean"] in records_to_add:
+                self.tables[table][record["ean"]] = record
+
+    def upsert_records(
+        self, records: list, table: str, restore: bool = False
+    ) -> None:
+        if restore and self.deleted not in self.columns[table]:
+            raise KeyError(f"column {self.deleted} does not exist")
+        for record in records:
+            self.tables[table][record["ean"]] = record
+
+    def route_partitions(
+        self, eans: list, table: str, partitions: list
+    ) -> dict[str, list]:
+        self.queries.append(("route", table))
+        routes = {}
+        for ean in eans:
+            partition = partitions[int(ean) % len(partitions)]
+            routes.setdefault(partition, []).append(ean)
+        return routes
+
+    def get_manifest(self, table: str) -> tuple[str, str] | None:
+        return self.manifests.get(table)
+
+    def save_manifest(
+        self, table: str, fingerprint: str, code_version: str
+    ) -> None:
+        self.manifests[table] = (fingerprint, code_version)
+
+
+def connect_database() -> Database | None:
+    """
+    Database of the test environment
+    None if it is not reachable, tests using it are skipped
+    :return:
+    """
+    try:
+        return Database(verbose=False)
+    except Exception:  # pylint: disable=broad-except
+        return None
 
 
 class Discount(unittest.TestCase):
@@ -68,5 +188,1349 @@ class Discount(unittest.TestCase):
         self.assertEqual(discount, "30%")
 
 
+class PricingRules(unittest.TestCase):
+    """
+    Testing Pricing().apply()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        self.pricing = Pricing(
+            [
+                {"match": {"brand": ["A"]}, "min_discount": 40},
+                {"match": {"brand": ["B"]}, "max_discount": 20},
+                {
+                    "match": {"brand": ["C"]},
+                    "rounding": "floor",
+                    "decimal_separator": ",",
+                    "currency": ["EUR"],
+                },
+            ]
+        )
+
+    def test_default(self):
+        """Tests if records matching no rule use the default rule"""
+        line = {"price": "70", "old_price": "100", "brand": "Z"}
+        self.assertEqual(self.pricing.discount(line), "30%")
+
+    def test_min_discount(self):
+        """Tests If discount below threshold is dropped"""
+        line = {"price": "70", "old_price": "100", "brand": "A"}
+        self.assertEqual(self.pricing.discount(line), "")
+
+    def test_max_discount(self):
+        """Tests If discount is capped"""
+        line = {"price": "70", "old_price": "100", "brand": "B"}
+        self.assertEqual(self.pricing.discount(line), "20%")
+
+    def test_currency(self):
+        """Tests currency parsing and floor rounding"""
+        line = {"price": "66,9 EUR", "old_price": "100 EUR", "brand": "C"}
+        self.assertEqual(self.pricing.discount(line), "33%")
+
+    def test_batch(self):
+        """Tests if the whole batch is annotated"""
+        batch = [
+            {"price": "70", "old_price": "100", "brand": "Z"},
+            {"price": "", "old_price": "100", "brand": "B"},
+        ]
+        self.pricing.apply(batch)
+        self.assertEqual([line["discount"] for line in batch], ["30%", ""])
+
+    def test_scalar_match(self):
+        """Tests if a single match value is not split into characters"""
+        pricing = Pricing([{"match": {"brand": "Acme"}, "max_discount": 5}])
+        line = {"price": "50", "old_price": "100", "brand": "Acme"}
+        self.assertEqual(pricing.discount(line), "5%")
+        line["brand"] = "A"
+        self.assertEqual(pricing.discount(line), "50%")
+
+    def test_width(self):
+        """Tests if rules are checked against the discount column width"""
+        with self.assertRaises(ValueError):
+            Pricing([{"match": {"brand": ["A"]}, "decimals": 1}], width=4)
+        pricing = Pricing([], {"decimals": 1, "max_discount": 9.9}, width=4)
+        line = {"price": "50", "old_price": "100"}
+        self.assertEqual(pricing.discount(line), "9.9%")
+        self.assertEqual(len(Pricing(width=4).discount(line)), 3)
+
+
+class Configuration(unittest.TestCase):
+    """
+    Testing Settings and LazyImport
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        self.settings = Settings.get()
+        self.argv = sys.argv
+        self.environ = os.environ.copy()
+
+    def tearDown(self) -> None:
+        sys.argv = self.argv
+        os.environ.clear()
+        os.environ.update(self.environ)
+        Settings._instance = self.settings  # pylint: disable=protected-access
+
+    def test_host_argv(self):
+        """Tests if arguments of the host process are not parsed"""
+        sys.argv = ["pytest", "-q", "-p", "no:cacheprovider", "-m", "x"]
+        Settings._instance = None  # pylint: disable=protected-access
+        settings = Settings.get()
+        self.assertEqual(settings.queue_size, 4)
+        self.assertEqual((settings.profile, settings.metrics), ("", ""))
+
+    def test_priority(self):
+        """Tests if arguments override environment"""
+        os.environ["WORKERS"] = "3"
+        self.assertEqual(Settings.configure([]).workers, 3)
+        self.assertEqual(Settings.configure(["-w", "5"]).workers, 5)
+
+    def test_lazy_import(self):
+        """Tests if the module is imported on first attribute access"""
+        module = LazyImport("colorsys")
+        self.assertIsNone(module._module)  # pylint: disable=protected-access
+        self.assertEqual(module.rgb_to_hsv(1, 0, 0), (0, 1, 1))
+        self.assertEqual(module.module.__name__, "colorsys")
+
+
+class Validation(unittest.TestCase):
+    """
+    Testing Validator().validate()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        self.validator = Validator()
+
+    @staticmethod
+    def record(**fields) -> dict:
+        """Valid record with overridden fields"""
+        return {
+            "ean": "4006381333931",
+            "title": "title",
+            "price": "70",
+            "old_price": "100",
+            "discount": "30%",
+        } | fields
+
+    def test_gtin(self):
+        """Tests GTIN check digit"""
+        self.assertTrue(gtin_is_valid("4006381333931"))
+        self.assertTrue(gtin_is_valid("96385074"))
+        self.assertFalse(gtin_is_valid("4006381333932"))
+        self.assertFalse(gtin_is_valid("40063813339a1"))
+
+    def test_clean(self):
+        """Tests column order and numeric conversion"""
+        clean = self.validator.validate([self.record(url="u")])
+        self.assertEqual(list(clean[0]), self.validator.columns)
+        self.assertEqual(clean[0]["price"], 70.0)
+        self.assertEqual(clean[0]["url"], "u")
+
+    def test_rejects(self):
+        """Tests if bad records are rejected"""
+        batch = [
+            self.record(ean="4006381333932"),
+            self.record(price="7O"),
+            self.record(status="x" * 257),
+            self.record(),
+        ]
+        clean = self.validator.validate(batch)
+        self.assertEqual(len(clean), 1)
+        self.assertEqual(self.validator.rejected, 3)
+
+
+class Dedup(unittest.TestCase):
+    """
+    Testing Deduplicator().add()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    batch = [
+        {"ean": "2", "discount": "10%", "title": "a"},
+        {"ean": "1", "discount": "", "title": "b"},
+        {"ean": "2", "discount": "30%", "title": "c"},
+        {"ean": "3", "discount": "5%", "title": "d"},
+        {"ean": "2", "discount": "20%", "title": "e"},
+        {"ean": "1", "discount": "1%", "title": "f"},
+    ]
+
+    def dedup(self, policy: str, memory_rows: int) -> dict:
+        """Winner title of every ean"""
+        deduplicator = Deduplicator(policy, memory_rows)
+        records = []
+        for record in self.batch:
+            records.extend(deduplicator.add([dict(record)]) or [])
+        records.extend(
+            record for batch in deduplicator.finish(2) for record in batch
+        )
+        self.assertEqual(deduplicator.duplicates, 3)
+        return {record["ean"]: record["title"] for record in records}
+
+    def test_first(self):
+        """Tests first-wins policy in memory and with spills"""
+        for memory_rows in (100, 1):
+            self.assertEqual(
+                self.dedup("first", memory_rows),
+                {"1": "b", "2": "a", "3": "d"},
+            )
+
+    def test_first_stream(self):
+        """Tests if first-wins policy emits records while adding"""
+        deduplicator = Deduplicator("first", 1)
+        emitted = [
+            deduplicator.add(self.batch[:3]),
+            deduplicator.add(self.batch[3:]),
+        ]
+        self.assertEqual(
+            [[record["title"] for record in batch or []] for batch in emitted],
+            [["a", "b"], ["d"]],
+        )
+        self.assertEqual(list(deduplicator.finish(2)), [])
+        self.assertEqual(deduplicator.duplicates, 3)
+
+    def test_last(self):
+        """Tests last-wins policy in memory and with spills"""
+        for memory_rows in (100, 1):
+            self.assertEqual(
+                self.dedup("last", memory_rows),
+                {"1": "f", "2": "e", "3": "d"},
+            )
+
+    def test_max_discount(self):
+        """Tests max-discount policy in memory and with spills"""
+        for memory_rows in (100, 2):
+            self.assertEqual(
+                self.dedup("max_discount", memory_rows),
+                {"1": "f", "2": "c", "3": "d"},
+            )
+
+
+class Export(unittest.TestCase):
+    """
+    Testing Exporter().write()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        # pylint: disable=consider-using-with
+        self.folder = tempfile.TemporaryDirectory()
+        self.exporter = Exporter(
+            os.path.join(self.folder.name, "gcn"), "csv", chunk_rows=2
+        )
+
+    def tearDown(self) -> None:
+        """
+        Removing exported files
+        :return:
+        """
+        self.folder.cleanup()
+
+    def test_csv_parts(self):
+        """Tests if csv export is split into parts by chunk rows"""
+        self.exporter.write([{"ean": str(ean)} for ean in range(3)])
+        files = self.exporter.close()
+        self.assertEqual(len(files), 2)
+        with gzip.open(files[1], "rt", encoding="utf-8") as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual([row["ean"] for row in rows], ["2"])
+
+    def test_csv_replace(self):
+        """Tests if the previous export stays until close"""
+        self.exporter.write([{"ean": str(ean)} for ean in range(5)])
+        previous = self.exporter.close()
+        exporter = Exporter(
+            os.path.join(self.folder.name, "gcn"), "csv", chunk_rows=2
+        )
+        exporter.write([{"ean": str(ean)} for ean in range(3)])
+        self.assertTrue(all(map(os.path.exists, previous)))
+        files = exporter.close()
+        self.assertEqual(
+            sorted(os.listdir(self.folder.name)),
+            sorted(map(os.path.basename, files)),
+        )
+        self.assertEqual(files, previous[:2])
+
+    def test_empty(self):
+        """Tests if an export without records keeps the previous one"""
+        self.exporter.write([{"ean": str(ean)} for ean in range(3)])
+        previous = self.exporter.close()
+        exporter = Exporter(
+            os.path.join(self.folder.name, "gcn"), "csv", chunk_rows=2
+        )
+        self.assertEqual(exporter.close(), [])
+        self.assertEqual(
+            sorted(os.listdir(self.folder.name)),
+            sorted(map(os.path.basename, previous)),
+        )
+
+
+class StageMetrics(unittest.TestCase):
+    """
+    Testing Metrics().stage()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        self.metrics = Metrics()
+
+    def test_accumulate(self):
+        """Tests if repeated stages are summed up"""
+        for _ in range(2):
+            with self.metrics.stage("stage") as stage:
+                stage.count(rows_in=10, rows_out=5)
+        stage = self.metrics.stages["stage"].as_dict()
+        self.assertEqual(stage["calls"], 2)
+        self.assertEqual(stage["rows_in"], 20)
+        self.assertEqual(stage["rows_out"], 10)
+
+    def test_current(self):
+        """Tests if counters go to the innermost stage"""
+        with self.metrics.stage("outer"):
+            with self.metrics.stage("inner"):
+                self.metrics.current().count(bytes_read=100)
+        self.assertEqual(self.metrics.stages["inner"].bytes_read, 100)
+        self.assertEqual(self.metrics.stages["outer"].bytes_read, 0)
+
+    def test_prometheus(self):
+        """Tests Prometheus textfile format"""
+        with self.metrics.stage("stage") as stage:
+            stage.count(rows_out=3)
+        self.assertIn(
+            'gcn_stage_rows_out{stage="stage"} 3',
+            self.metrics.as_prometheus(),
+        )
+
+    def test_thread_cpu(self):
+        """Tests if cpu time of a stage excludes other threads"""
+        stop = threading.Event()
+
+        def busy():
+            while not stop.is_set():
+                sum(range(1000))
+
+        thread = threading.Thread(target=busy)
+        thread.start()
+        try:
+            with self.metrics.stage("sleep"):
+                time.sleep(0.3)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertLess(self.metrics.stages["sleep"].cpu_time, 0.1)
+
+    def test_profile_threads(self):
+        """Tests if stage profiles of threads are merged in one file"""
+
+        def work():
+            for _ in range(3):
+                with self.metrics.stage("stage"):
+                    sum(range(1000))
+
+        with tempfile.TemporaryDirectory() as folder:
+            self.metrics.profile_dir = folder
+            threads = [threading.Thread(target=work) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            paths = self.metrics.dump_profiles()
+            self.assertEqual(paths, [os.path.join(folder, "stage.prof")])
+            stats = pstats.Stats(paths[0])
+        calls = [
+            stat[1]
+            for function, stat in stats.stats.items()
+            if function[2] == "<built-in method builtins.sum>"
+        ]
+        self.assertEqual(calls, [12])
+
+
+class Pipeline(unittest.TestCase):
+    """
+    Testing Engine().run()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        self.engine = Engine(queue_size=2)
+        self.engine.add(Node("source", lambda: iter(range(100))))
+
+    def test_ordered(self):
+        """Tests if parallel node keeps input order"""
+        self.engine.add(
+            Node("double", lambda x: x * 2, inputs=["source"], workers=4,
+                 collect=True)
+        )
+        results = self.engine.run()
+        self.assertEqual(results["double"], [x * 2 for x in range(100)])
+
+    def test_fan_out(self):
+        """Tests if items are broadcast to every downstream node"""
+        self.engine.add(
+            Node("first", lambda x: x, inputs=["source"], collect=True)
+        )
+        self.engine.add(
+            Node("second", lambda x: x, inputs=["source"], workers=2,
+                 ordered=False, collect=True)
+        )
+        results = self.engine.run()
+        self.assertEqual(results["first"], list(range(100)))
+        self.assertEqual(sorted(results["second"]), list(range(100)))
+
+    def test_error(self):
+        """Tests if node error cancels the run and is re-raised"""
+        def fail(item):
+            if item == 10:
+                raise ValueError(item)
+            return item
+
+        self.engine.add(Node("fail", fail, inputs=["source"], workers=2))
+        with self.assertRaises(ValueError):
+            self.engine.run()
+        self.assertTrue(self.engine.cancelled)
+
+
+class Parser(unittest.TestCase):
+    """
+    Testing CsvParser().rows()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        # pylint: disable=consider-using-with
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "data.csv.gz")
+        with gzip.open(self.path, "wt", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["ean", "title", "price"])
+            writer.writerow(["1", 'quoted "title", with\nnewline', "10"])
+            writer.writerow(["2", "", "20.5"])
+
+    def tearDown(self) -> None:
+        """
+        Removing data file
+        :return:
+        """
+        self.folder.cleanup()
+
+    def test_rows(self):
+        """Tests if rows are tuples in header order"""
+        rows = list(CsvParser(self.path, "python").rows())
+        self.assertEqual(
+            rows,
+            [("1", 'quoted "title", with\nnewline', "10"), ("2", "", "20.5")],
+        )
+
+    def test_columns(self):
+        """Tests if only selected columns are returned in given order"""
+        parser = CsvParser(self.path, "python")
+        self.assertEqual(
+            list(parser.rows(["price", "ean"])),
+            [("10", "1"), ("20.5", "2")],
+        )
+        self.assertEqual(list(parser.rows(["ean"])), [("1",), ("2",)])
+        with self.assertRaises(KeyError):
+            list(parser.rows(["missing"]))
+
+    def test_predicate(self):
+        """Tests if rows out of keys are skipped but counted as read"""
+        parser = CsvParser(self.path, "python")
+        self.assertEqual(
+            list(parser.rows(["price"], "ean", {"2"})), [("20.5",)]
+        )
+        self.assertEqual(parser.rows_read, 2)
+        self.assertEqual(len(list(parser.rows(["ean"], "ean", None))), 2)
+
+    @unittest.skipUnless(has_arrow_csv(), "pyarrow is not installed")
+    def test_arrow(self):
+        """Tests if arrow backend returns the same rows and columns"""
+        python = CsvParser(self.path, "python")
+        arrow = CsvParser(self.path, "arrow")
+        self.assertEqual(list(arrow.rows()), list(python.rows()))
+        self.assertEqual(
+            list(arrow.column_batches(["ean"])), [{"ean": ["1", "2"]}]
+        )
+        self.assertEqual(
+            list(arrow.rows(["price"], "ean", {"2"})), [("20.5",)]
+        )
+        self.assertEqual(arrow.rows_read, 2)
+
+    @unittest.skipUnless(has_arrow_csv(), "pyarrow is not installed")
+    def test_arrow_short_rows(self):
+        """Tests if arrow backend pads short rows like python backend"""
+        with gzip.open(self.path, "wt", encoding="utf-8") as file:
+            file.write("ean,price,brand\n")
+            for ean in range(50):
+                file.write(f"{ean},{ean}\n" if ean == 40 else f"{ean},1,B\n")
+        arrow = CsvParser(self.path, "arrow")
+        arrow.block_size = 128
+        rows = list(arrow.rows())
+        self.assertEqual(rows, list(CsvParser(self.path, "python").rows()))
+        self.assertEqual(rows[40], ("40", "40", ""))
+        self.assertEqual(
+            list(arrow.rows(["brand"], "ean", {"2", "40"})), [("B",), ("",)]
+        )
+        self.assertEqual(arrow.rows_read, 50)
+
+    def test_blank_lines(self):
+        """Tests if blank lines are skipped by both backends"""
+        with gzip.open(self.path, "wt", encoding="utf-8") as file:
+            file.write("ean,price,brand\n")
+            for ean in range(50):
+                file.write(f"{ean},{ean}\n" if ean == 40 else f"{ean},1,B\n")
+                if ean in (0, 20):
+                    file.write("\n")
+        python = CsvParser(self.path, "python")
+        rows = list(python.rows(["ean"]))
+        self.assertEqual(rows, [(str(ean),) for ean in range(50)])
+        self.assertEqual(python.rows_read, 50)
+        if has_arrow_csv():
+            arrow = CsvParser(self.path, "arrow")
+            arrow.block_size = 128
+            self.assertEqual(list(arrow.rows(["ean"])), rows)
+
+
+class Columnar(unittest.TestCase):
+    """
+    Testing Transcoder().transcode() and ColumnarFile().rows()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        # pylint: disable=consider-using-with
+        self.folder = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.folder.name, "data.csv.gz")
+        self.rows = [
+            ("1", "Ünïcode\ntitle", "10.5", "20"),
+            ("2", "nul\0inside", "", "abc"),
+            ("3", "", "7", "8"),
+        ]
+        with gzip.open(
+            self.source, "wt", encoding="utf-8", newline=""
+        ) as file:
+            writer = csv.writer(file)
+            writer.writerow(["ean", "title", "price", "old_price"])
+            writer.writerows(self.rows)
+        self.transcoder = Transcoder(
+            os.path.join(self.folder.name, "data.cols")
+        )
+
+    def tearDown(self) -> None:
+        """
+        Removing files
+        :return:
+        """
+        self.folder.cleanup()
+
+    def test_rows(self):
+        """Tests if values survive transcoding"""
+        columnar = ColumnarFile(self.transcoder.transcode(self.source))
+        self.assertEqual(
+            columnar.header, ["ean", "title", "price", "old_price"]
+        )
+        self.assertEqual(
+            list(columnar.rows()),
+            [
+                ("1", "Ünïcode\ntitle", 10.5, "20"),
+                ("2", "nul\0inside", "", "abc"),
+                ("3", "", 7.0, "8"),
+            ],
+        )
+
+    def test_predicate(self):
+        """Tests if rows out of keys are skipped"""
+        columnar = ColumnarFile(self.transcoder.transcode(self.source))
+        self.assertEqual(
+            list(columnar.rows(["title", "price"], "ean", {"3", "2"})),
+            [("nul\0inside", ""), ("", 7.0)],
+        )
+        self.assertEqual(columnar.rows_read, 3)
+
+    def test_fresh(self):
+        """Tests if the copy gets stale when the source changes"""
+        self.assertFalse(self.transcoder.is_fresh(self.source))
+        self.transcoder.transcode(self.source)
+        self.assertTrue(self.transcoder.is_fresh(self.source))
+        with gzip.open(self.source, "at", encoding="utf-8") as file:
+            file.write("4,new,1,2\n")
+        self.assertFalse(self.transcoder.is_fresh(self.source))
+
+
+class Changes(unittest.TestCase):
+    """
+    Testing Delta().add() and Delta().commit()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        # pylint: disable=consider-using-with
+        self.folder = tempfile.TemporaryDirectory()
+        self.changelog = os.path.join(self.folder.name, "changelog.jsonl.gz")
+        self.delta = Delta(
+            "gcn",
+            self.folder.name,
+            changelog=self.changelog,
+            schema="ean VARCHAR(32), price REAL",
+        )
+        # snapshot of the previous run, read on the first batch
+        columns = ["ean", "price"]
+        with gzip.open(self.delta.snapshot, "wb") as file:
+            pickle.dump(
+                {
+                    "1": record_hash({"ean": "1", "price": 1.0}, columns),
+                    "2": record_hash({"ean": "2", "price": 2.0}, columns),
+                },
+                file,
+            )
+
+    def tearDown(self) -> None:
+        """
+        Removing snapshot and changelog
+        :return:
+        """
+        self.folder.cleanup()
+
+    def test_changes(self):
+        """Tests if only added and changed records are passed on"""
+        changes = self.delta.add(
+            [
+                {"ean": "1", "price": 1.0},
+                {"ean": "2", "price": 2.5},
+                {"ean": "3", "price": 3.0},
+            ]
+        )
+        self.assertEqual([record["ean"] for record in changes], ["2", "3"])
+        self.assertEqual(
+            self.delta.commit(), {"added": 1, "changed": 1, "removed": 0}
+        )
+        with gzip.open(self.changelog, "rt", encoding="utf-8") as file:
+            lines = [json.loads(line) for line in file]
+        self.assertEqual(
+            [(line["op"], line["record"]["ean"]) for line in lines],
+            [("changed", "2"), ("added", "3")],
+        )
+        with gzip.open(self.delta.snapshot, "rb") as file:
+            self.assertEqual(set(pickle.load(file)), {"1", "2", "3"})
+
+    def test_soft_upsert(self):
+        """Tests if a soft delta prepares a table without the flag"""
+        database = StubDatabase({"gcn": {"1": {"ean": "1"}}})
+        delta = Delta(
+            "gcn", self.folder.name, "soft", database=database
+        )
+        changes = delta.add([{"ean": "1", "price": 5.0}])
+        with self.assertRaises(KeyError):
+            upsert_records(database, changes, "gcn", restore=True)
+        prepare_delta(database, "gcn", delta)
+        upsert_records(database, changes, "gcn", restore=True)
+        self.assertEqual(database.tables["gcn"]["1"]["price"], 5.0)
+
+    def test_changelog_per_table(self):
+        """Tests if feeds get own changelogs and the run connection"""
+        database = StubDatabase()
+        settings = Settings.get()
+        Settings.configure(
+            ["--delta", "delete", "--changelog", self.changelog]
+        )
+        try:
+            deltas = [
+                pipelines.make_delta(table, False, self.folder.name, database)
+                for table in ("shop_a", "shop_b")
+            ]
+        finally:
+            Settings._instance = settings  # pylint: disable=protected-access
+        self.assertEqual(
+            [os.path.basename(delta.changelog) for delta in deltas],
+            ["changelog-shop_a.jsonl.gz", "changelog-shop_b.jsonl.gz"],
+        )
+        self.assertIs(deltas[0].database, database)
+
+
+class Refresh(unittest.TestCase):
+    """
+    Testing DatabaseStatic.split_schema() and DatabaseStatic.copy_line()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        self.database = DatabaseStatic()
+
+    def test_split_schema(self):
+        """Tests if constraints are removed from the shadow schema"""
+        schema, constraints = self.database.split_schema(
+            "id SERIAL PRIMARY KEY, ean VARCHAR(32) UNIQUE NOT NULL, "
+            "price REAL"
+        )
+        self.assertNotIn("PRIMARY KEY", schema)
+        self.assertNotIn("UNIQUE", schema)
+        self.assertIn("ean VARCHAR(32) NOT NULL", schema)
+        self.assertEqual(
+            constraints, [("PRIMARY KEY", "id"), ("UNIQUE", "ean")]
+        )
+
+    def test_copy_line(self):
+        """Tests if COPY text format escapes values and NULL"""
+        self.assertEqual(
+            self.database.copy_line(["a\tb\\", None, "", 1.5]),
+            "a\\tb\\\\\t\\N\t\t1.5\n",
+        )
+
+
+class Tables(unittest.TestCase):
+    """
+    Testing Database table operations on a real database:
+    swap_shadow_table(), restore_backup(), partitions
+    """
+
+    table = "gcn_test"
+    partitioned = "gcn_test_parts"
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+        if (database := connect_database()) is None:
+            raise unittest.SkipTest("database is not reachable")
+        cls.database = database
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        self.tearDown()
+        self.database.create_table(self.table)
+        self._insert(self.table, "old")
+
+    def tearDown(self) -> None:
+        self.database.rollback()
+        self.database.execute_query(f"DROP VIEW IF EXISTS {self.table}_v")
+        for suffix in ("", "_shadow", "_backup"):
+            self.database.drop_table_if_exists(f"{self.table}{suffix}")
+        self.database.drop_table_if_exists(self.partitioned)
+        pipelines.release_thread_database()
+
+    def _insert(self, table: str, ean: str) -> None:
+        self.database.execute_query(
+            f"INSERT INTO {table} (ean) VALUES (%s)", (ean,)
+        )
+        self.database.commit()
+
+    def _query(self, query: str, args: tuple = None) -> list:
+        self.database.execute_query(query, args)
+        return self.database.fetch()
+
+    def _names(self, table: str) -> set[str]:
+        """
+        Indexes and sequences of the table
+        :param table:
+        :return:
+        """
+        indexes = self._query(
+            "SELECT indexname FROM pg_indexes WHERE tablename = %s",
+            (table,),
+        )
+        sequence = self._query(
+            "SELECT pg_get_serial_sequence(%s, 'id')", (table,)
+        )
+        return {name for (name,) in indexes + sequence}
+
+    def test_swap(self):
+        """Tests if the shadow replaces the table with its names"""
+        self.database.execute_query(
+            f"CREATE VIEW {self.table}_v AS SELECT ean FROM {self.table}"
+        )
+        self.database.commit()
+        shadow = self.database.create_shadow_table(self.table)
+        self.database.copy_records([{"ean": "new"}], shadow)
+        self.database.swap_shadow_table(self.table)
+        table, backup = self.table, f"{self.table}_backup"
+        self.assertEqual(
+            self._names(table),
+            {f"{table}_pkey", f"{table}_ean_key", f"public.{table}_id_seq"},
+        )
+        self.assertEqual(
+            self._names(backup),
+            {f"{backup}_pkey", f"{backup}_ean_key", f"public.{backup}_id_seq"},
+        )
+        self.assertEqual(self._query(f"SELECT ean FROM {table}_v"), [("new",)])
+        self.database.restore_backup(table)
+        self.assertEqual(self._query(f"SELECT ean FROM {table}_v"), [("old",)])
+        self.assertEqual(self._query(f"SELECT ean FROM {backup}"), [("new",)])
+
+    def test_partitions(self):
+        """Tests if partitions are listed and routed by remainder"""
+        table = self.partitioned
+        self.database.create_table(table, partitions=12)
+        partitions = self.database.get_partitions(table)
+        self.assertEqual(partitions, [f"{table}_p{i}" for i in range(12)])
+        self.assertEqual(self.database.get_partitions(self.table), [])
+        eans = [str(4006381333931 + ean) for ean in range(100)]
+        routes = self.database.route_partitions(eans, table, partitions)
+        self.assertEqual(sorted(sum(routes.values(), [])), sorted(eans))
+        self.database.upsert_records([{"ean": ean} for ean in eans], table)
+        for partition, routed in routes.items():
+            self.assertEqual(
+                sorted(self._query(f"SELECT ean FROM {partition}")),
+                sorted((ean,) for ean in routed),
+            )
+
+    def test_refresh_partitioned(self):
+        """Tests if a partitioned table is not replaced by a refresh"""
+        self.database.create_table(self.partitioned, partitions=2)
+        settings = Settings.get()
+        Settings.configure(["--refresh"])
+        # pylint: disable-next=protected-access
+        pipelines._local.database = self.database
+        try:
+            with self.assertRaises(ValueError):
+                pipelines.run_pipeline(self.partitioned)
+        finally:
+            Settings._instance = settings  # pylint: disable=protected-access
+        self.assertFalse(
+            self.database.table_exists(f"{self.partitioned}_shadow")
+        )
+
+
+class Feeds(unittest.TestCase):
+    """
+    Testing FeedRegistry().load() and Scheduler().order()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        # pylint: disable=consider-using-with
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "feeds.json")
+        with open(self.path, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "defaults": {"concurrency": 3},
+                    "feeds": [
+                        {"name": "small", "size": 10},
+                        {"name": "large", "size": 1000, "table": "gcn"},
+                        {"name": "medium", "size": 100, "concurrency": 1},
+                    ],
+                },
+                file,
+            )
+        self.registry = FeedRegistry.load(self.path)
+
+    def tearDown(self) -> None:
+        """
+        Removing registry file
+        :return:
+        """
+        self.folder.cleanup()
+
+    def test_registry(self):
+        """Tests if defaults are applied and names are table defaults"""
+        feeds = {feed.name: feed for feed in self.registry.feeds}
+        self.assertEqual(feeds["small"].concurrency, 3)
+        self.assertEqual(feeds["medium"].concurrency, 1)
+        self.assertEqual(feeds["small"].table, "small")
+        self.assertEqual(feeds["large"].table, "gcn")
+
+    def test_exports(self):
+        """Tests if every feed gets its own export"""
+        settings = Settings.get()
+        Settings.configure(["--export", "gcn"])
+        try:
+            self.assertEqual(
+                [feed.export for feed in FeedRegistry.load(self.path).feeds],
+                ["gcn-small", "gcn-large", "gcn-medium"],
+            )
+            registry = FeedRegistry([Feed("a", export="gcn")])
+            with self.assertRaises(ValueError):
+                registry.add(Feed("b", export="gcn"))
+        finally:
+            Settings._instance = settings  # pylint: disable=protected-access
+
+    def test_largest_first(self):
+        """Tests if the largest feeds are scheduled first"""
+        order = Scheduler(self.registry.feeds).order()
+        self.assertEqual(
+            [feed.name for feed in order], ["large", "medium", "small"]
+        )
+
+    def test_budget(self):
+        """Tests if connections are capped by the budget"""
+        budget = ConnectionBudget(4)
+        self.assertEqual(budget.acquire(10), 4)
+        self.assertEqual(budget.available, 0)
+        budget.release(4)
+        self.assertEqual(budget.acquire(3), 3)
+        self.assertEqual(budget.available, 1)
+
+
+class Loading(unittest.TestCase):
+    """
+    Testing pipelines.load_records()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        self.database = StubDatabase({"gcn": {"1": {"ean": "1"}}})
+
+    def test_known_eans(self):
+        """Tests if the table is read once for all batches of a run"""
+        known = KnownEans()
+        for batch in (["1", "2"], ["3"], ["2", "4"]):
+            load_records(
+                self.database,
+                [{"ean": ean} for ean in batch],
+                "gcn",
+                known,
+            )
+        self.assertEqual(self.database.queries, [("eans", "gcn")])
+        self.assertEqual(sorted(self.database.tables["gcn"]), list("1234"))
+
+
+class Manifest(unittest.TestCase):
+    """
+    Testing pipelines.manifest_stage() and core.code_version()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        self.database = StubDatabase({"gcn": {}})
+        # pylint: disable-next=protected-access
+        pipelines._local.database = self.database
+        # pylint: disable-next=consider-using-with
+        self.folder = tempfile.TemporaryDirectory()
+        self.files = {
+            "folder": self.folder.name,
+            "eans": "eans.csv",
+            "data": "data.csv",
+        }
+        for file in ("eans.csv", "data.csv"):
+            self._write(file, "ean\n1\n")
+
+    def tearDown(self) -> None:
+        pipelines.release_thread_database()
+        self.folder.cleanup()
+
+    def _write(self, file: str, content: str) -> None:
+        path = os.path.join(self.folder.name, file)
+        with open(path, "w", encoding="utf-8") as csv_file:
+            csv_file.write(content)
+
+    def _stage(self) -> str | None:
+        return pipelines.manifest_stage(table="gcn", files=self.files)
+
+    def test_round_trip(self):
+        """Tests if a saved load is skipped until inputs change"""
+        fingerprint = self._stage()
+        self.assertIsNotNone(fingerprint)
+        self.database.save_manifest(
+            "gcn", fingerprint, pipelines.code_version()
+        )
+        self.assertIsNone(self._stage())
+        self._write("data.csv", "ean\n2\n")
+        self.assertNotIn(self._stage(), (None, fingerprint))
+
+    def test_output_settings(self):
+        """Tests if output settings and refresh are not skipped"""
+        self.database.save_manifest(
+            "gcn", self._stage(), pipelines.code_version()
+        )
+        settings = Settings.get()
+        try:
+            for argv in (["--delta", "soft"], ["--dedup", "last"]):
+                Settings.configure(argv)
+                self.assertIsNotNone(self._stage())
+            Settings.configure([])
+            self.database.save_manifest(
+                "gcn", self._stage(), pipelines.code_version()
+            )
+            Settings.configure(["--refresh"])
+            self.assertIsNotNone(self._stage())
+        finally:
+            Settings._instance = settings  # pylint: disable=protected-access
+
+    def test_pricing_rules(self):
+        """Tests if pricing rules are a part of the fingerprint"""
+        fingerprint = self._stage()
+        self._write("rules.json", '{"default": {"decimals": 0}}')
+        settings = Settings.get()
+        Settings.configure(
+            ["--pricing_rules", os.path.join(self.folder.name, "rules.json")]
+        )
+        try:
+            self.assertNotEqual(self._stage(), fingerprint)
+        finally:
+            Settings._instance = settings  # pylint: disable=protected-access
+
+    def test_noop_export(self):
+        """Tests if a skipped run keeps the previous export"""
+        header = "ean,title,description,price,old_price,status,brand"
+        self._write("eans.csv", "ean,active\n4006381333931,1\n")
+        self._write("data.csv", f"{header}\n4006381333931,T,D,70,100,s,B\n")
+        export = os.path.join(self.folder.name, "out")
+        settings = Settings.get()
+        Settings.configure(
+            ["--export", export, "--export_format", "csv", "--no_print_out"]
+        )
+        files = list(self.files.values())
+        try:
+            with mock.patch.object(
+                pipelines, "downloader_pipeline", return_value=files
+            ), mock.patch.object(
+                pipelines, "Database", return_value=self.database
+            ):
+                self.assertTrue(pipelines.run_pipeline(files=self.files))
+                self.assertFalse(pipelines.run_pipeline(files=self.files))
+        finally:
+            Settings._instance = settings  # pylint: disable=protected-access
+        with gzip.open(
+            f"{export}.part-00000.csv.gz", "rt", encoding="utf-8"
+        ) as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual([row["ean"] for row in rows], ["4006381333931"])
+
+    def test_code_version(self):
+        """Tests if tests and tools are not in the code version"""
+        modules = [os.path.basename(path) for path in runtime_sources()]
+        self.assertIn("pipelines.py", modules)
+        self.assertNotIn("tests.py", modules)
+        self.assertNotIn("check_project.py", modules)
+
+
+class Daemons(unittest.TestCase):
+    """
+    Testing Daemon().cycle(), Daemon().stop() and Daemon()._wait()
+    """
+
+    # pylint: disable=protected-access
+    header = "ean,title,description,price,old_price,status,brand,color,url"
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        # pylint: disable-next=consider-using-with
+        self.folder = tempfile.TemporaryDirectory()
+        self._write("eans.csv", "ean,active\n4006381333931,1\n")
+        self._write(
+            "data.csv",
+            f"{self.header}\n4006381333931,T,D,70,100,in stock,B,red,u\n",
+        )
+        self.database = StubDatabase()
+        self.daemon = Daemon(
+            interval=0.2,
+            download=False,
+            files={
+                "folder": self.folder.name,
+                "eans": "eans.csv",
+                "data": "data.csv",
+            },
+            database=self.database,
+        )
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def _write(self, file: str, content: str) -> None:
+        path = os.path.join(self.folder.name, file)
+        with open(path, "w", encoding="utf-8") as csv_file:
+            csv_file.write(content)
+
+    def _watch(self, *names: str) -> None:
+        """
+        Stub inotify watcher returning events of the files once
+        :param names:
+        :return:
+        """
+        events = [[SimpleNamespace(name=name) for name in names]]
+        self.daemon._watcher = SimpleNamespace(
+            read=lambda timeout: events.pop() if events else []
+        )
+
+    def test_cycle(self):
+        """Tests if a cycle loads new inputs only once"""
+        self.daemon._warm_up()
+        self.assertTrue(self.daemon.cycle())
+        self.assertEqual(list(self.database.tables["gcn"]), ["4006381333931"])
+        self.assertIn("gcn", self.database.manifests)
+        self.assertFalse(self.daemon.cycle())
+        self._write("eans.csv", "ean,active\n4006381333931,0\n")
+        self.assertEqual(self.daemon._changed(), ["eans"])
+
+    def test_stop(self):
+        """Tests if a stopped daemon exits after the current cycle"""
+        self.daemon.stop()
+        self.assertEqual(self.daemon.state["status"], "stopping")
+        self.daemon.run()
+        self.assertEqual(self.daemon.state["status"], "stopped")
+        self.assertEqual(self.daemon.state["cycles"], 0)
+
+    def test_wait_outputs(self):
+        """Tests if events of the daemon outputs do not wake it up"""
+        self._watch("health.json", "health.json.tmp", "rejects.jsonl.gz")
+        started = time.monotonic()
+        self.daemon._wait()
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_wait_inputs(self):
+        """Tests if events of the input files wake the daemon up"""
+        self.daemon._interval = 60
+        self._watch("health.json", "data.csv")
+        started = time.monotonic()
+        self.daemon._wait()
+        self.assertLess(time.monotonic() - started, 1)
+
+
+class Partitions(unittest.TestCase):
+    """
+    Testing pipelines.partition_stage()
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Printing name of cls
+        :return:
+        """
+        print(f"Test Case: {cls.__name__}")
+
+    def setUp(self) -> None:
+        """
+        Calling New Instance Each Test
+        :return:
+        """
+        self.engine = Engine(queue_size=2)
+        self.loaded = []
+
+    def _load(self, records: list, table: str = "gcn") -> None:
+        self.loaded.append((table, records))
+
+    def test_partition_stage(self):
+        """Tests if records are loaded into their partition"""
+        records = [{"ean": "4006381333931"}]
+        partition_stage(("gcn_p1", records), partial(self._load, table="gcn"))
+        self.assertEqual(self.loaded, [("gcn_p1", records)])
+
+    def test_route_stage(self):
+        """Tests if batches are routed by partitions given once per run"""
+        database = StubDatabase()
+        # pylint: disable-next=protected-access
+        pipelines._local.database = database
+        partitions = ["gcn_p0", "gcn_p1"]
+        try:
+            routed = [
+                list(
+                    pipelines.route_stage(
+                        [{"ean": ean} for ean in batch], "gcn", partitions
+                    )
+                )
+                for batch in (["1", "2", "3"], ["4"])
+            ]
+        finally:
+            pipelines.release_thread_database()
+        self.assertEqual(
+            routed,
+            [
+                [
+                    ("gcn_p1", [{"ean": "1"}, {"ean": "3"}]),
+                    ("gcn_p0", [{"ean": "2"}]),
+                ],
+                [("gcn_p0", [{"ean": "4"}])],
+            ],
+        )
+        self.assertEqual(database.queries, [("route", "gcn")] * 2)
+
+    def test_routed_load(self):
+        """Tests if every routed group is loaded by parallel workers"""
+
+        def route(batch):
+            for remainder in range(2):
+                yield f"gcn_p{remainder}", batch[remainder::2]
+
+        self.engine.add(Node("source", lambda: iter([[1, 2, 3], [4, 5]])))
+        self.engine.add(Node("route", route, inputs=["source"]))
+        self.engine.add(
+            Node(
+                "load",
+                partial(partition_stage, load=self._load),
+                inputs=["route"],
+                workers=2,
+                ordered=False,
+            )
+        )
+        self.engine.run()
+        self.assertEqual(
+            sorted(self.loaded),
+            [
+                ("gcn_p0", [1, 3]),
+                ("gcn_p0", [4]),
+                ("gcn_p1", [2]),
+                ("gcn_p1", [5]),
+            ],
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
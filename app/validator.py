@@ -0,0 +1,200 @@
+"""
+Validator Module
+Batch validation and normalization of records before the database load
+"""
+import os
+import re
+import gzip
+import json
+import math
+import threading
+from core import Verbose
+from database import DatabaseBase, DatabaseStatic
+from decorators import measure
+from metrics import METRICS
+
+GTIN_LENGTHS = (8, 12, 13, 14)
+
+
+def gtin_is_valid(ean: str) -> bool:
+    """
+    GTIN-8/12/13/14 check digit
+    :param ean:
+    :return:
+    """
+    if len(ean) not in GTIN_LENGTHS or not ean.isascii() or not ean.isdigit():
+        return False
+    digits = ean[::-1]
+    total = sum(map(int, digits[1::2])) * 3 + sum(map(int, digits[2::2]))
+    return (10 - total % 10) % 10 == int(digits[0])
+
+
+def parse_price(value) -> float | None:
+    """
+    Float of a price field, 0 for empty values
+    None if not a finite number
+    :param value:
+    :return:
+    """
+    if value is None or value == "":
+        return 0.0
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+class ValidatorBase(Verbose):
+    """
+    Validator Low-Level Interface
+    Limits are taken from the database schema
+    """
+
+    _real = re.compile(r"^(\w+)\s+REAL", re.IGNORECASE)
+    _not_null = re.compile(r"^(\w+)\s.*NOT NULL", re.IGNORECASE)
+
+    def __init__(
+        self,
+        schema: str = DatabaseBase.schema,
+        gtin: bool = True,
+        verbose: bool = None,
+    ) -> None:
+        Verbose.__init__(self, verbose)
+        definitions = [
+            column.strip() for column in schema.strip().split(",")
+        ]
+        self._columns = DatabaseStatic.columns_from_schema(schema)
+        self._lengths = DatabaseStatic.varchar_lengths(schema)
+        self._numeric = [
+            match[1]
+            for column in definitions
+            if (match := self._real.match(column))
+        ]
+        self._required = [
+            match[1]
+            for column in definitions
+            if (match := self._not_null.match(column))
+            and match[1] in self._columns
+        ]
+        self._gtin = gtin
+
+    @property
+    def columns(self) -> list[str]:
+        """
+        Wrapper
+        :return:
+        """
+        return self._columns
+
+    def _check_column(self, column: str, values: list) -> list:
+        """
+        Reason of rejection for each value of a column, None if valid
+        :param column:
+        :param values:
+        :return:
+        """
+        reasons = [None] * len(values)
+        if column in self._required:
+            reasons = [
+                f"{column}: missing" if value in (None, "") else None
+                for value in values
+            ]
+        if column in self._lengths:
+            limit = self._lengths[column]
+            reasons = [
+                reason
+                or (
+                    f"{column}: longer than {limit}"
+                    if value is not None and len(str(value)) > limit
+                    else None
+                )
+                for reason, value in zip(reasons, values)
+            ]
+        if column == "ean" and self._gtin:
+            reasons = [
+                reason
+                or (None if gtin_is_valid(value) else "ean: invalid GTIN")
+                for reason, value in zip(reasons, values)
+            ]
+        return reasons
+
+
+class Validator(ValidatorBase):
+    """
+    Validator High-Level Interface
+    Rejected records are written with reasons
+    to a gzip JSON lines file
+    """
+
+    def __init__(self, *args, rejects: str = "", **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._message("Initializing Validator")
+        self._rejects = rejects
+        self._lock = threading.Lock()
+        self._rejected = 0
+        self._started = False
+
+    @property
+    def rejected(self) -> int:
+        """
+        Number of rejected records
+        :return:
+        """
+        return self._rejected
+
+    def _write_rejects(self, rejects: list[dict]) -> None:
+        with self._lock:
+            self._rejected += len(rejects)
+            if not self._rejects:
+                return
+            with gzip.open(self._rejects, "at", encoding="utf-8") as file:
+                file.writelines(
+                    json.dumps(reject, ensure_ascii=False) + "\n"
+                    for reject in rejects
+                )
+
+    @measure("validator.validate")
+    def validate(self, batch: list[dict]) -> list[dict]:
+        """
+        Clean records of the batch:
+        schema columns only, in schema order,
+        numeric columns converted to float
+        :param batch:
+        :return:
+        """
+        with self._lock:
+            if not self._started:
+                # rejects of the previous run
+                self._started = True
+                if self._rejects and os.path.exists(self._rejects):
+                    os.remove(self._rejects)
+        columns = {
+            column: [record.get(column) for record in batch]
+            for column in self.columns
+        }
+        reasons = [[] for _ in batch]
+        for column in self._numeric:
+            columns[column] = list(map(parse_price, columns[column]))
+            for index, value in enumerate(columns[column]):
+                if value is None:
+                    reasons[index].append(f"{column}: not a number")
+        for column, values in columns.items():
+            for index, reason in enumerate(self._check_column(column, values)):
+                if reason:
+                    reasons[index].append(reason)
+
+        clean = []
+        rejects = []
+        for index, row in enumerate(zip(*columns.values())):
+            if reasons[index]:
+                rejects.append(
+                    {"reasons": reasons[index], "record": batch[index]}
+                )
+            else:
+                clean.append(dict(zip(self.columns, row)))
+        if rejects:
+            self._message(f"Rejected records: {len(rejects)}")
+            self._write_rejects(rejects)
+        METRICS.current().count(rows_in=len(batch))
+        return clean